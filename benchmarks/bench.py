@@ -0,0 +1,198 @@
+"""
+offline benchmarks of the hot paths against a local MockNode.
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --blocks 50 --txs 200 --latency 0.02 --error-rate 0.01
+    python benchmarks/bench.py --fixtures recorded.jsonl.gz --only block_range
+
+every scenario reports throughput, rpc calls per block, p50/p99 latency of one
+unit of work and the peak python memory (tracemalloc, measured in a second run
+so it doesn't slow down the timed one).
+"""
+
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tests.mocknode import Fixtures, MockNode  # noqa: E402
+from w3tools import address, block, bytecode, tx  # noqa: E402
+from w3tools.block import Block  # noqa: E402
+from w3tools.chain import ChainId  # noqa: E402
+from w3tools.tx import TX  # noqa: E402
+from w3tools.w3 import make_w3  # noqa: E402
+
+CHAIN = ChainId.ETH
+
+
+def clear_caches():
+    block.cache.clear()
+    tx.cache_header.clear()
+    address.cache_code.clear()
+    bytecode.cache_code_info.clear()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+## scenarios, each takes (w3, numbers) and returns per unit latencies
+def block_serial(w3, numbers):
+    latencies = []
+    for number in numbers:
+        start = time.perf_counter()
+        Block.from_w3(CHAIN, number, w3)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def block_range(w3, numbers):
+    latencies = []
+    start = time.perf_counter()
+    for _ in Block.from_w3_range(CHAIN, numbers[0], numbers[-1] + 1, w3):
+        now = time.perf_counter()
+        latencies.append(now - start)
+        start = now
+    return latencies
+
+
+def tx_properties(w3, numbers):
+    latencies = []
+    for number in numbers:
+        b = Block.from_w3(CHAIN, number, w3)
+        start = time.perf_counter()
+        for t in b.txs:
+            t.timestamp, t.fee, t.internal_txs_num, t.max_call_depth, t.logs_num
+        b.decode_logs()
+        b.sandwiches
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def standalone_txs(w3, numbers):
+    latencies = []
+    for number in numbers:
+        txhashes = Block.from_w3(CHAIN, number, w3, need_txdatas=False).txhashes
+        start = time.perf_counter()
+        for txhash in txhashes:
+            t = TX(CHAIN, txhash, w3=w3)
+            t.timestamp, t.status, t.internal_txs_num
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def classify_addresses(w3, numbers):
+    latencies = []
+    for number in numbers:
+        b = Block.from_w3(CHAIN, number, w3, need_traces=False)
+        addresses = {log["address"] for t in b.txs for log in t.logs}
+        addresses.update(t.sender for t in b.txs)
+        start = time.perf_counter()
+        address.classify(addresses, CHAIN, w3)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+SCENARIOS = {
+    "block_serial": (block_serial, {}),
+    "block_serial_raw": (block_serial, {"raw": True}),
+    "block_range": (block_range, {}),
+    "block_range_raw": (block_range, {"raw": True}),
+    "tx_properties": (tx_properties, {}),
+    "standalone_txs": (standalone_txs, {}),
+    "classify": (classify_addresses, {}),
+}
+
+
+def run(name, node, numbers, batch_size=None):
+    scenario, w3_kwargs = SCENARIOS[name]
+
+    def once():
+        clear_caches()
+        w3 = make_w3(
+            CHAIN,
+            "custom",
+            endpoint=node.endpoint,
+            cache=False,
+            batch_size=batch_size,
+            **w3_kwargs,
+        )
+        node.reset_stats()
+        gc.collect()
+        start = time.perf_counter()
+        latencies = scenario(w3, numbers)
+        return time.perf_counter() - start, latencies
+
+    elapsed, latencies = once()
+    calls = sum(node.calls.values())
+    posts = node.posts
+
+    tracemalloc.start()
+    once()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "blocks/s": len(numbers) / elapsed,
+        "calls/block": calls / len(numbers),
+        "posts/block": posts / len(numbers),
+        "p50 ms": percentile(latencies, 0.5) * 1000,
+        "p99 ms": percentile(latencies, 0.99) * 1000,
+        "peak MB": peak / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fixtures", help="recorded fixtures, synthetic when omitted")
+    parser.add_argument("--blocks", type=int, default=20)
+    parser.add_argument("--txs", type=int, default=100, help="txs per synthetic block")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--only", action="append", choices=list(SCENARIOS))
+    args = parser.parse_args()
+
+    if args.fixtures:
+        fixtures = Fixtures.load(args.fixtures)
+        numbers = sorted(fixtures.numbers())[: args.blocks]
+    else:
+        fixtures = Fixtures.synthetic(blocks=args.blocks, txs_per_block=args.txs)
+        numbers = list(range(1000, 1000 + args.blocks))
+
+    node = MockNode(
+        fixtures,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        seed=0,
+    )
+    with node:
+        rows = [
+            run(name, node, numbers, args.batch_size) for name in args.only or SCENARIOS
+        ]
+
+    columns = list(rows[0])
+    print(
+        "  ".join(f"{c:>18}" if i == 0 else f"{c:>11}" for i, c in enumerate(columns))
+    )
+    for row in rows:
+        print(
+            "  ".join(
+                f"{v:>18}" if i == 0 else f"{v:>11.2f}"
+                for i, v in enumerate(row.values())
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import pytest
+
+from tests.mocknode import Fixtures, MockNode
+from w3tools import block
+from w3tools.cache import HeadTracker
+
+
+@pytest.fixture(scope="session")
+def fixtures():
+    # head is 1079, so 1000-1015 are final on eth (64 blocks) and 1070- are not
+    return Fixtures.synthetic(start=1000, blocks=80, txs_per_block=5, contracts=20)
+
+
+@pytest.fixture
+def node(fixtures):
+    with MockNode(fixtures) as node:
+        yield node
+
+
+@pytest.fixture(autouse=True)
+def heads(monkeypatch):
+    """a head tracker of its own, so heads seen by other tests don't leak in"""
+    tracker = HeadTracker()
+    monkeypatch.setattr(block, "heads", tracker)
+    return tracker
@@ -0,0 +1,322 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from web3 import Web3
+
+from w3tools.address import ERC20_METHODS, LPV2_METHODS
+from w3tools.cassette import Cassette
+from w3tools.raw import loads
+from w3tools.sandwich import UNISWAP_V2_SWAP
+
+BLOCK_TAGS = ("latest", "safe", "finalized", "pending")
+
+
+class Fixtures(Cassette):
+    """Cassette which can also make up a chain, see synthetic"""
+
+    @classmethod
+    def synthetic(
+        cls, start=1000, blocks=100, txs_per_block=100, contracts=500, seed=0
+    ) -> "Fixtures":
+        """
+        made up but well formed chain: txs call erc20 tokens and v2 pairs, emit
+        Transfer and Swap logs and have nested traces, every address has code.
+        """
+        rng = random.Random(seed)
+        fixtures = cls()
+        address = lambda i: "0x%040x" % (0x1000 + i)
+        eoas = [address(i) for i in range(contracts)]
+        tokens = [address(contracts + i) for i in range(contracts // 2)]
+        pairs = [address(2 * contracts + i) for i in range(contracts // 2)]
+        push4 = lambda selectors: b"".join(b"\x63" + s for s in selectors)
+        erc20_code = "0x" + (b"\x60\x80" + push4(ERC20_METHODS) + b"\x00").hex()
+        pair_code = "0x" + (b"\x60\x80" + push4(LPV2_METHODS) + b"\x00").hex()
+        for eoa in eoas:
+            fixtures.put_result("eth_getCode", [eoa, "latest"], "0x")
+        for token in tokens:
+            fixtures.put_result("eth_getCode", [token, "latest"], erc20_code)
+        for pair in pairs:
+            fixtures.put_result("eth_getCode", [pair, "latest"], pair_code)
+
+        transfer = (
+            "0x" + Web3.keccak(text="Transfer(address,address,uint256)").hex()[-64:]
+        )
+        swap = "0x" + UNISWAP_V2_SWAP.hex()[-64:]
+        word = lambda i: "%064x" % i
+        topic = lambda a: "0x" + "0" * 24 + a[2:]
+        tracer = {"tracer": "callTracer"}
+        with_log = {"tracer": "callTracer", "tracerConfig": {"withLog": True}}
+
+        for number in range(start, start + blocks):
+            block_hash = "0x%064x" % (number << 32 | 0xB)
+            parent_hash = "0x%064x" % ((number - 1) << 32 | 0xB)
+            txs, receipts, traces = [], [], []
+            for i in range(txs_per_block):
+                txhash = "0x%064x" % (number << 32 | i << 8 | 0xA)
+                sender = rng.choice(eoas)
+                token, pair = rng.choice(tokens), rng.choice(pairs)
+                amount = rng.randrange(1, 10**20)
+                txdata = {
+                    "hash": txhash,
+                    "from": sender,
+                    "to": pair,
+                    "value": "0x0",
+                    "gas": hex(200000),
+                    "gasPrice": hex(rng.randrange(10**9, 10**11)),
+                    "input": "0x022c0d9f" + word(amount) * 4,
+                    "nonce": hex(rng.randrange(1000)),
+                    "blockNumber": hex(number),
+                    "blockHash": block_hash,
+                    "transactionIndex": hex(i),
+                    "type": "0x0",
+                    "chainId": "0x1",
+                    "v": "0x25",
+                    "r": "0x" + word(rng.getrandbits(255)),
+                    "s": "0x" + word(rng.getrandbits(255)),
+                }
+                zero_for_one = rng.random() < 0.5
+                amounts = (
+                    [amount, 0, 0, amount] if zero_for_one else [0, amount, amount, 0]
+                )
+                logs = [
+                    {
+                        "address": token,
+                        "topics": [transfer, topic(sender), topic(pair)],
+                        "data": "0x" + word(amount),
+                    },
+                    {
+                        "address": pair,
+                        "topics": [swap, topic(sender), topic(sender)],
+                        "data": "0x" + "".join(word(a) for a in amounts),
+                    },
+                ]
+                for j, log in enumerate(logs):
+                    log.update(
+                        blockNumber=hex(number),
+                        blockHash=block_hash,
+                        transactionHash=txhash,
+                        transactionIndex=hex(i),
+                        logIndex=hex(i * 2 + j),
+                        removed=False,
+                    )
+                receipt = {
+                    "transactionHash": txhash,
+                    "transactionIndex": hex(i),
+                    "blockNumber": hex(number),
+                    "blockHash": block_hash,
+                    "from": sender,
+                    "to": pair,
+                    "status": "0x1" if rng.random() < 0.95 else "0x0",
+                    "gasUsed": hex(rng.randrange(21000, 200000)),
+                    "cumulativeGasUsed": hex(21000 * (i + 1)),
+                    "effectiveGasPrice": txdata["gasPrice"],
+                    "contractAddress": None,
+                    "logs": logs,
+                    "logsBloom": "0x" + "00" * 256,
+                    "type": "0x0",
+                }
+                trace = {
+                    "type": "CALL",
+                    "from": sender,
+                    "to": pair,
+                    "value": "0x0",
+                    "gas": hex(200000),
+                    "gasUsed": receipt["gasUsed"],
+                    "input": txdata["input"],
+                    "calls": [
+                        {
+                            "type": "CALL",
+                            "from": pair,
+                            "to": token,
+                            "value": "0x0",
+                            "input": "0xa9059cbb",
+                            "calls": [
+                                {
+                                    "type": "STATICCALL",
+                                    "from": token,
+                                    "to": rng.choice(tokens),
+                                    "input": "0x70a08231",
+                                }
+                            ],
+                        },
+                        {
+                            "type": "STATICCALL",
+                            "from": pair,
+                            "to": token,
+                            "input": "0x70a08231",
+                        },
+                    ],
+                }
+                txs.append(txdata)
+                receipts.append(receipt)
+                traces.append({"txHash": txhash, "result": trace})
+                fixtures.put_result("eth_getTransactionByHash", [txhash], txdata)
+                fixtures.put_result("eth_getTransactionReceipt", [txhash], receipt)
+                fixtures.put_result("debug_traceTransaction", [txhash, with_log], trace)
+
+            block = {
+                "number": hex(number),
+                "hash": block_hash,
+                "parentHash": parent_hash,
+                "timestamp": hex(1700000000 + number * 12),
+                "miner": rng.choice(eoas),
+                "baseFeePerGas": hex(10**9),
+                "gasLimit": hex(30000000),
+                "gasUsed": hex(21000 * txs_per_block),
+                "extraData": "0x",
+                "logsBloom": "0x" + "00" * 256,
+                "difficulty": "0x0",
+                "totalDifficulty": "0x0",
+                "nonce": "0x0000000000000000",
+                "mixHash": "0x" + "00" * 32,
+                "sha3Uncles": "0x" + "00" * 32,
+                "stateRoot": "0x" + "00" * 32,
+                "receiptsRoot": "0x" + "00" * 32,
+                "transactionsRoot": "0x" + "00" * 32,
+                "size": hex(1000),
+                "uncles": [],
+            }
+            for full in (True, False):
+                result = dict(
+                    block, transactions=txs if full else [tx["hash"] for tx in txs]
+                )
+                fixtures.put_result("eth_getBlockByNumber", [hex(number), full], result)
+                fixtures.put_result("eth_getBlockByHash", [block_hash, full], result)
+            fixtures.put_result("eth_getBlockReceipts", [hex(number)], receipts)
+            fixtures.put_result(
+                "debug_traceBlockByNumber", [hex(number), tracer], traces
+            )
+        return fixtures
+
+
+class MockNode:
+    """
+    local json-rpc server replaying Fixtures or recorded cassettes, for offline
+    tests and benchmarks.
+
+    every http request waits latency (+ up to jitter) seconds, and each call fails
+    with a rate limit error with probability error_rate. Block tags resolve to the
+    highest block in the fixtures.
+
+    e.g.
+        with MockNode(Fixtures.synthetic(), latency=0.01) as node:
+            w3 = make_w3(ChainId.ETH, "custom", endpoint=node.endpoint)
+    """
+
+    def __init__(
+        self,
+        fixtures: Cassette,
+        chain_id=1,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        host="127.0.0.1",
+        port=0,
+        seed=None,
+    ):
+        self.fixtures = fixtures
+        self.chain_id = chain_id
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self.calls = Counter()
+        self.posts = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def endpoint(self):
+        return f"http://{self.host}:{self.port}"
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.posts = 0
+            self.bytes_sent = 0
+
+    def start(self) -> "MockNode":
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                data = node.handle_body(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self._server = Server((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle_body(self, body: bytes) -> bytes:
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.random() * self.jitter)
+        request = loads(body)
+        if isinstance(request, list):
+            response = [self.handle(r) for r in request]
+        else:
+            response = self.handle(request)
+        data = json.dumps(response).encode()
+        with self._lock:
+            self.posts += 1
+            self.bytes_sent += len(data)
+        return data
+
+    def handle(self, request: dict) -> dict:
+        method, params = request["method"], request.get("params") or []
+        with self._lock:
+            self.calls[method] += 1
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        if self.error_rate and self._random.random() < self.error_rate:
+            response["error"] = {"code": 429, "message": "too many requests"}
+            return response
+
+        if method == "eth_chainId":
+            response["result"] = hex(self.chain_id)
+            return response
+        if method == "eth_blockNumber":
+            response["result"] = hex(self.fixtures.head or 0)
+            return response
+        if method in ("eth_getBlockByNumber", "eth_getBlockReceipts") and params:
+            params = [
+                hex(self.fixtures.head or 0) if p in BLOCK_TAGS and i == 0 else p
+                for i, p in enumerate(params)
+            ]
+
+        recorded = self.fixtures.get(method, params)
+        if recorded is None:
+            response["error"] = {"code": -32601, "message": f"no fixture: {method}"}
+        else:
+            response.update(recorded)
+        return response
@@ -0,0 +1,44 @@
+import pytest
+
+from w3tools import block
+from w3tools.block import Block
+from w3tools.cache import ReorgAwareCache
+from w3tools.cassette import CassetteMiss
+from w3tools.chain import ChainId
+from w3tools.retry import RetryError
+from w3tools.w3 import make_w3
+
+
+def test_replay_serves_recorded_and_fails_fast_on_a_miss(node, tmp_path, monkeypatch):
+    path = str(tmp_path / "cassette.jsonl")
+    w3 = make_w3(
+        ChainId.ETH,
+        "custom",
+        endpoint=node.endpoint,
+        cassette=path,
+        cassette_mode="record",
+        cache=False,
+    )
+    recorded = Block.from_w3(ChainId.ETH, 1020, w3=w3)
+    w3.provider.save()
+
+    w3 = make_w3(
+        ChainId.ETH,
+        "custom",
+        endpoint=node.endpoint,
+        cassette=path,
+        cassette_mode="replay",
+        cache=False,
+    )
+    monkeypatch.setattr(block, "cache", ReorgAwareCache())
+    node.reset_stats()
+    replayed = Block.from_w3(ChainId.ETH, 1020, w3=w3)
+    assert replayed.hash == recorded.hash
+    assert [tx.txhash for tx in replayed.txs] == [tx.txhash for tx in recorded.txs]
+
+    # a miss is fatal, it isn't retried
+    with pytest.raises(RetryError, match="after 1 attempts") as e:
+        Block.from_w3(ChainId.ETH, 1021, w3=w3)
+    assert isinstance(e.value.__cause__, CassetteMiss)
+    assert w3.provider.misses == 1
+    assert node.posts == 0
@@ -0,0 +1,62 @@
+from tests.mocknode import MockNode
+from w3tools.chain import ChainId
+from w3tools.follower import ChainFollower
+from w3tools.w3 import make_w3
+
+
+def _orphan(block_hash):
+    return "0xf" + block_hash[3:]
+
+
+class ForkingNode(MockNode):
+    """serves other hashes for every block from fork on, as after a reorg"""
+
+    fork = None
+
+    def handle(self, request):
+        response = super().handle(request)
+        if (
+            self.fork is None
+            or request["method"] != "eth_getBlockByNumber"
+            or not response.get("result")
+        ):
+            return response
+        block = dict(response["result"])
+        number = int(block["number"], 16)
+        if number >= self.fork:
+            block["hash"] = _orphan(block["hash"])
+        if number - 1 >= self.fork:
+            block["parentHash"] = _orphan(block["parentHash"])
+        return {**response, "result": block}
+
+
+def test_follower_rolls_back_to_the_fork(fixtures):
+    # near the head, blocks 64 deep are final and can't be reorged
+    with ForkingNode(fixtures) as node:
+        w3 = make_w3(ChainId.ETH, "custom", endpoint=node.endpoint, cache=True)
+        follower = ChainFollower(
+            ChainId.ETH,
+            w3=w3,
+            start=1060,
+            checkpoint=None,
+            concurrency=4,
+            need_receipts=False,
+            need_traces=False,
+        )
+        seen, rollbacks = [], []
+        follower.on_block(lambda b: seen.append((b.header.number, b.hash.hex())))
+        follower.on_rollback(rollbacks.append)
+
+        follower.sync_to(1070)
+        assert [number for number, _ in seen] == list(range(1060, 1071))
+        assert rollbacks == []
+
+        node.fork = 1065
+        follower.sync_to(1075)
+
+    assert rollbacks == [1064]
+    replayed = seen[11:]
+    assert [number for number, _ in replayed] == list(range(1065, 1076))
+    orphans = {number: h for number, h in seen[:11] if number >= 1065}
+    assert all(orphans[number] != h for number, h in replayed if number in orphans)
+    assert follower.checkpoint.number == 1075
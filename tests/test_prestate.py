@@ -0,0 +1,63 @@
+import pytest
+
+from tests.mocknode import Fixtures, MockNode
+from w3tools.chain import ChainId
+from w3tools.prestate import local_evm
+from w3tools.tx import TX
+from w3tools.w3 import make_w3
+
+pytest.importorskip("eth", reason="needs the sim extra (py-evm)")
+
+# returns sload(caller)
+CODE = "0x33546000526020" + "6000f3"
+BOB = "0x" + "b0" * 20
+# second tx of block 1001, see Fixtures.synthetic
+TXHASH = "0x%064x" % (1001 << 32 | 1 << 8 | 0xA)
+
+
+class StateNode(MockNode):
+    """traces a prestate where the sender's slot is 5, every other slot is 7"""
+
+    to = sender = None
+
+    def handle(self, request):
+        method, params = request["method"], request.get("params") or []
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        if method == "debug_traceTransaction":
+            slot = "0x%064x" % int(self.sender, 16)
+            response["result"] = {
+                self.to: {
+                    "balance": "0x0",
+                    "nonce": 1,
+                    "code": CODE,
+                    "storage": {slot: "0x%064x" % 5},
+                },
+                self.sender: {"balance": "0x" + "f" * 20, "nonce": 1},
+            }
+        elif method == "eth_getStorageAt":
+            response["result"] = "0x%064x" % 7
+        elif method in ("eth_getBalance", "eth_getTransactionCount"):
+            response["result"] = "0x0"
+        elif method == "eth_getCode":
+            response["result"] = CODE if params[0].lower() == self.to else "0x"
+        else:
+            return super().handle(request)
+        return response
+
+
+def test_state_missing_from_a_mined_tx_prestate_is_inexact():
+    with StateNode(Fixtures.synthetic(blocks=5)) as node:
+        w3 = make_w3(ChainId.ETH, "custom", endpoint=node.endpoint)
+        tx = TX(ChainId.ETH, TXHASH, w3=w3)
+        node.to, node.sender = tx.to.lower(), tx.sender.lower()
+        evm = local_evm(ChainId.ETH, tx, w3=w3)
+
+        traced = evm.call({})
+        # bob's slot isn't in the prestate, it's read at the end of the parent
+        # block, before the txs ahead of this one
+        variant = evm.call({"from": BOB})
+
+    assert int.from_bytes(traced.output, "big") == 5
+    assert traced.exact
+    assert int.from_bytes(variant.output, "big") == 7
+    assert not variant.exact
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from web3 import Web3
+
+from tests.mocknode import MockNode
+from w3tools.chain import ChainId
+from w3tools.provider import Batch
+from w3tools.w3 import make_w3
+
+EOAS = [Web3.to_checksum_address("0x%040x" % (0x1000 + i)) for i in range(20)]
+
+
+def test_concurrent_requests_are_coalesced(node):
+    w3 = make_w3(
+        ChainId.ETH,
+        "custom",
+        endpoint=node.endpoint,
+        cache=False,
+        batch_size=10,
+        batch_delay=0.05,
+    )
+    node.reset_stats()
+    with ThreadPoolExecutor(20) as executor:
+        codes = list(executor.map(lambda a: w3.eth.get_code(a, "latest"), EOAS))
+
+    assert codes == [b""] * 20
+    assert node.calls["eth_getCode"] == 20
+    assert node.posts < 20
+
+
+def test_batch_size_passes_through_pool(fixtures):
+    with MockNode(fixtures) as a, MockNode(fixtures) as b:
+        w3 = make_w3(ChainId.ETH, "pool", endpoint=[a.endpoint, b.endpoint])
+        a.reset_stats()
+        b.reset_stats()
+        with Batch(w3, batch_size=5) as batch:
+            for number in range(1000, 1020):
+                batch.add("eth_getBlockByNumber", [hex(number), False])
+
+    assert [block["number"] for block in batch.results] == list(range(1000, 1020))
+    assert a.posts + b.posts == 4
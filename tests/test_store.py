@@ -0,0 +1,36 @@
+from w3tools import block
+from w3tools.block import Block
+from w3tools.cache import ReorgAwareCache
+from w3tools.chain import ChainId
+from w3tools.store import Store
+from w3tools.w3 import make_w3
+
+
+def test_only_finalized_blocks_are_stored(node, tmp_path):
+    w3 = make_w3(ChainId.ETH, "custom", endpoint=node.endpoint)
+    store = Store(tmp_path / "w3tools.db")
+
+    final = Block.from_w3(ChainId.ETH, 1010, w3=w3, store=store)
+    recent = Block.from_w3(ChainId.ETH, 1070, w3=w3, store=store)
+
+    for kind in ("block", "receipts", "traces"):
+        assert store.get(ChainId.ETH, kind, hash=final.hash) is not None
+        assert store.get(ChainId.ETH, kind, hash=recent.hash) is None
+    assert store.get(ChainId.ETH, "block", number=1070) is None
+    store.close()
+
+
+def test_stored_blocks_are_read_back(node, tmp_path, monkeypatch):
+    w3 = make_w3(ChainId.ETH, "custom", endpoint=node.endpoint, cache=False)
+    store = Store(tmp_path / "w3tools.db")
+    fetched = Block.from_w3(ChainId.ETH, 1011, w3=w3, store=store)
+
+    # nothing cached in memory, the store has to serve it
+    monkeypatch.setattr(block, "cache", ReorgAwareCache())
+    node.reset_stats()
+    stored = Block.from_w3(ChainId.ETH, 1011, w3=w3, store=store)
+
+    assert stored.hash == fetched.hash
+    assert len(stored.txs) == len(fetched.txs) == 5
+    assert sum(node.calls.values()) == 0
+    store.close()
@@ -0,0 +1,180 @@
+import json
+from functools import cache, lru_cache
+from pathlib import Path
+from typing import List
+
+from eth_abi.abi import default_codec
+from eth_abi.grammar import TupleType, parse
+from eth_utils.abi import collapse_if_tuple
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+ABI_DIR = Path(__file__).resolve().parent.parent / "etc" / "abi"
+
+_registry = default_codec._registry
+_stream = default_codec.stream_class
+# the same few addresses show up in most logs, checksumming hashes each time
+_checksum = lru_cache(maxsize=100000)(Web3.to_checksum_address)
+
+
+def _to_bytes(value) -> bytes:
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+    return bytes(value)
+
+
+def _is_hashed(type_str) -> bool:
+    """indexed reference types are stored as the keccak of their value"""
+    abi_type = parse(type_str)
+    return (
+        isinstance(abi_type, TupleType)
+        or abi_type.is_array
+        or (abi_type.base in ("string", "bytes") and not abi_type.sub)
+    )
+
+
+def _normalizer(type_str):
+    if type_str == "address":
+        return _checksum
+    if type_str.startswith("address[") and type_str.endswith("]"):
+        return lambda values: [_checksum(v) for v in values]
+    return None
+
+
+class EventDecoder:
+    """one event abi with its eth_abi decoders built up front"""
+
+    def __init__(self, event_abi: dict, abi_name: str = None):
+        self.name = event_abi["name"]
+        self.abi_name = abi_name
+        types = [collapse_if_tuple(i) for i in event_abi["inputs"]]
+        self.signature = f"{self.name}({','.join(types)})"
+        self.topic0 = Web3.keccak(text=self.signature)
+
+        self.names = [i["name"] for i in event_abi["inputs"]]
+        self.topic_decoders = []  # (name, decoder or None for hashed values)
+        data_names, data_types = [], []
+        for i, type_str in zip(event_abi["inputs"], types):
+            if i["indexed"]:
+                decoder = (
+                    None if _is_hashed(type_str) else _registry.get_decoder(type_str)
+                )
+                self.topic_decoders.append((i["name"], decoder))
+            else:
+                data_names.append(i["name"])
+                data_types.append(type_str)
+        self.data_names = data_names
+        self.data_decoder = _registry.get_tuple_decoder(*data_types)
+        self.normalizers = [
+            (i["name"], normalizer)
+            for i, type_str in zip(event_abi["inputs"], types)
+            if (normalizer := _normalizer(type_str)) is not None
+            and not (i["indexed"] and _is_hashed(type_str))
+        ]
+
+    @property
+    def topics_num(self) -> int:
+        return 1 + len(self.topic_decoders)
+
+    def decode_args(self, topics, data) -> dict:
+        args = {}
+        for (name, decoder), topic in zip(self.topic_decoders, topics[1:]):
+            topic = _to_bytes(topic)
+            args[name] = topic if decoder is None else decoder(_stream(topic))
+        values = self.data_decoder(_stream(_to_bytes(data)))
+        args.update(zip(self.data_names, values))
+        for name, normalizer in self.normalizers:
+            args[name] = normalizer(args[name])
+        # keep abi order
+        return {name: args[name] for name in self.names}
+
+    def decode(self, log) -> AttributeDict:
+        """same shape as web3's process_log"""
+        return AttributeDict(
+            {
+                "args": AttributeDict(self.decode_args(log["topics"], log["data"])),
+                "event": self.name,
+                "address": log["address"],
+                "logIndex": log.get("logIndex"),
+                "transactionIndex": log.get("transactionIndex"),
+                "transactionHash": log.get("transactionHash"),
+                "blockHash": log.get("blockHash"),
+                "blockNumber": log.get("blockNumber"),
+            }
+        )
+
+
+class EventRegistry:
+    """
+    event decoders indexed by (topic0, topics num).
+
+    topics num is part of the key because events like erc20 and erc721 Transfer
+    share a signature but not the indexed layout. When two abis define the same
+    event, the first registered wins.
+    """
+
+    def __init__(self):
+        self.decoders = {}
+
+    def __len__(self):
+        return len(self.decoders)
+
+    def register(self, abi: List[dict], abi_name: str = None):
+        for item in abi:
+            if item.get("type") != "event" or item.get("anonymous"):
+                continue
+            decoder = EventDecoder(item, abi_name)
+            self.decoders.setdefault((decoder.topic0, decoder.topics_num), decoder)
+
+    def load_file(self, path):
+        path = Path(path)
+        with open(path) as f:
+            abi = json.load(f)
+        if isinstance(abi, dict):
+            abi = abi["abi"]
+        self.register(abi, path.stem)
+
+    def load_dir(self, path=ABI_DIR):
+        for file in sorted(Path(path).glob("*.json")):
+            self.load_file(file)
+
+    def get(self, log) -> EventDecoder:
+        topics = log["topics"]
+        if not topics:
+            return None
+        return self.decoders.get((_to_bytes(topics[0]), len(topics)))
+
+    def decode(self, log) -> AttributeDict:
+        """decoded log, None when the event is unknown or the log doesn't fit it"""
+        decoder = self.get(log)
+        if decoder is None:
+            return None
+        try:
+            return decoder.decode(log)
+        except Exception:
+            return None
+
+    def decode_logs(self, logs) -> List[AttributeDict]:
+        """decode known events, unknown logs are skipped"""
+        decoded = []
+        get = self.decoders.get
+        for log in logs:
+            topics = log["topics"]
+            if not topics:
+                continue
+            decoder = get((_to_bytes(topics[0]), len(topics)))
+            if decoder is None:
+                continue
+            try:
+                decoded.append(decoder.decode(log))
+            except Exception:
+                continue
+        return decoded
+
+
+@cache
+def default_registry() -> EventRegistry:
+    """every abi in etc/abi, loaded once"""
+    registry = EventRegistry()
+    registry.load_dir(ABI_DIR)
+    return registry
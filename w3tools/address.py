@@ -1,7 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+
 from cacheout import LRUCache
 from loguru import logger
 from web3 import Web3
 
+from w3tools.bytecode import CodeInfo, analyze
+from w3tools.chain import ChainId
+from w3tools.metrics import metrics
 from w3tools.w3 import make_w3
 
 ERC20_METHODS = [
@@ -17,8 +23,8 @@ ERC20_METHODS = [
 ]
 
 LPV2_METHODS = [
-    Web3.keccak(text="reverse0()")[0:4],
-    Web3.keccak(text="reverse1()")[0:4],
+    Web3.keccak(text="token0()")[0:4],
+    Web3.keccak(text="token1()")[0:4],
     Web3.keccak(text="getReserves()")[0:4],
 ]
 
@@ -29,56 +35,121 @@ LPV3_METHODS = [
     Web3.keccak(text="tickSpacing()")[0:4],
 ]
 
-cache_eoa = LRUCache(maxsize=10000)
-cache_erc20 = LRUCache(maxsize=10000)
-cache_lpv2 = LRUCache(maxsize=10000)
-cache_lpv3 = LRUCache(maxsize=10000)
+# (chain, address) -> CodeInfo, one get_code per address for every classifier
+cache_code = LRUCache(maxsize=10000)
+
+
+def code_info(address, chain=None, w3=None) -> CodeInfo:
+    """
+    analyzed code of address, minimal proxies are resolved to their implementation
+
+    :param chain: taken from w3 when not given, one of the two is needed
+    """
+    if chain is None:
+        if w3 is None:
+            raise ValueError("code_info needs a chain or a w3")
+        # every classifier caches under the same (chain, address) key
+        chain = getattr(w3, "chain", None) or ChainId(w3.eth.chain_id)
+    key = (chain, address)
+    info = cache_code.get(key)
+    metrics.record_cache("address", info is not None)
+    if info is None:
+        if w3 is None:
+            w3 = make_w3(chain)
+        info = analyze(w3.eth.get_code(address))
+        if info.implementation is not None:
+            info = replace(code_info(info.implementation, chain, w3), size=info.size)
+        cache_code.set(key, info)
+    return info
 
 
-@cache_eoa.memoize()
 def is_eoa(address, w3=None, chain=None):
-    """check if address is EOA"""
-    if w3 is None:
-        w3 = make_w3(chain)
-
-    code = w3.eth.get_code(address)
-    if code == b"":
-        return True
-    else:
-        return False
+    """check if address is EOA, chain is taken from w3 when not given"""
+    return code_info(address, chain, w3).is_empty
 
 
 def _helper(address, chain, w3, methods):
-    if w3 is None:
-        w3 = make_w3(chain)
     try:
-        code = w3.eth.get_code(address)
-        for method in methods:
-            if method not in code:
-                return False
-        return True
+        return code_info(address, chain, w3).has_selectors(methods)
     except Exception as e:
         logger.warning(f"Failed to check {address}: {e}")
         return False
 
 
-@cache_erc20.memoize()
 def is_erc20(address, chain, w3=None):
     """check if address is ERC20 contract"""
     return _helper(address, chain, w3, ERC20_METHODS)
 
 
-@cache_lpv2.memoize()
 def is_lpv2(address, chain, w3=None):
     """check if address is LPV2 contract"""
     return _helper(address, chain, w3, LPV2_METHODS)
 
 
-@cache_lpv3.memoize()
 def is_lpv3(address, chain, w3=None):
     """check if address is LPV3 contract"""
     return _helper(address, chain, w3, LPV3_METHODS)
 
 
+@dataclass
+class AddressFlags:
+    is_eoa: bool
+    is_erc20: bool
+    is_lpv2: bool
+    is_lpv3: bool
+
+    @classmethod
+    def from_code_info(cls, info: CodeInfo):
+        return cls(
+            is_eoa=info.is_empty,
+            is_erc20=info.has_selectors(ERC20_METHODS),
+            is_lpv2=info.has_selectors(LPV2_METHODS),
+            is_lpv3=info.has_selectors(LPV3_METHODS),
+        )
+
+
+def classify(addresses, chain, w3=None, batch_size=100, max_workers=4) -> dict:
+    """
+    classify many addresses at once, return {address: AddressFlags}
+
+    addresses already in cache_code are skipped, the rest are fetched with batched
+    eth_getCode, max_workers batches at a time. Addresses whose code can't be
+    fetched are logged and left out.
+    """
+    if w3 is None:
+        w3 = make_w3(chain)
+    addresses = list(dict.fromkeys(addresses))
+    missing = [a for a in addresses if not cache_code.has((chain, a))]
+    metrics.record_cache("address", True, len(addresses) - len(missing))
+    metrics.record_cache("address", False, len(missing))
+
+    def fetch(chunk):
+        with w3.batch() as batch:
+            for address in chunk:
+                batch.add("eth_getCode", [address, "latest"])
+        for address, code in zip(chunk, batch.results):
+            if code is None:
+                logger.warning(f"Failed to get code of {address}")
+                continue
+            info = analyze(code)
+            if info.implementation is not None:
+                info = replace(
+                    code_info(info.implementation, chain, w3), size=info.size
+                )
+            cache_code.set((chain, address), info)
+
+    chunks = [missing[i : i + batch_size] for i in range(0, len(missing), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(fetch, chunks):
+            pass
+
+    flags = {}
+    for address in addresses:
+        info = cache_code.get((chain, address))
+        if info is not None:
+            flags[address] = AddressFlags.from_code_info(info)
+    return flags
+
+
 if __name__ == "__main__":
     print(is_erc20("0x0f3284bFEbc5f55B849c8CF792D39cC0f729e0BC"))
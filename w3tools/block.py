@@ -1,18 +1,89 @@
-import time
-from collections import Counter
+from collections import Counter, deque
+from collections.abc import Mapping
+from concurrent.futures import Executor, ThreadPoolExecutor
 from dataclasses import dataclass
-from functools import cached_property
-from typing import List
+from functools import cached_property, partial
+from itertools import islice
+from typing import Iterator, List
 
-from cacheout import LFUCache
 from loguru import logger
+from web3.exceptions import BlockNotFound
 from web3.types import BlockIdentifier, TxData, TxReceipt
 
+from w3tools.abi import EventRegistry, default_registry
+from w3tools.cache import ReorgAwareCache, heads
 from w3tools.chain import ChainId as Chain
-from w3tools.tx import TX
+from w3tools.columns import AddressTable, BlockColumns
+from w3tools.metrics import metrics
+from w3tools.retry import MissingResultError, RetryError, call_with_retry
+from w3tools.sandwich import Sandwich, find_sandwiches
+from w3tools.store import Store
+from w3tools.tx import TX, BlockHeader, cache_header
 from w3tools.w3 import make_w3
 
-cache = LFUCache(maxsize=10)
+cache = ReorgAwareCache(maxsize=10)
+
+
+def _get_block(w3, block_identifier, full_transactions):
+    if isinstance(block_identifier, str) and len(block_identifier) == 66:
+        method = "eth_getBlockByHash"
+    else:
+        method = "eth_getBlockByNumber"
+
+    def fetch():
+        if getattr(w3, "raw", False):
+            data = w3.raw_request(method, [block_identifier, full_transactions])
+        else:
+            try:
+                data = w3.eth.get_block(
+                    block_identifier, full_transactions=full_transactions
+                )
+            except BlockNotFound:
+                data = None
+        if data is None:
+            # not yet seen by this node, e.g. a head from another one
+            raise MissingResultError(f"no block {block_identifier}")
+        return data
+
+    return call_with_retry(w3, method, fetch)
+
+
+def _get_receipts(w3, block_identifier):
+    def fetch():
+        if getattr(w3, "raw", False):
+            receipts = w3.raw_request("eth_getBlockReceipts", [block_identifier])
+        else:
+            receipts = w3.eth.get_block_receipts(block_identifier)
+        if receipts is None:
+            raise MissingResultError(f"no receipts for {block_identifier}")
+        return receipts
+
+    try:
+        return call_with_retry(w3, "eth_getBlockReceipts", fetch)
+    except RetryError as e:
+        logger.error(f"get block receipts error: {block_identifier}, {e}")
+        return None
+
+
+def _get_traces(w3, block_identifier):
+    tracer = {"tracer": "callTracer"}
+
+    def fetch():
+        if getattr(w3, "raw", False):
+            traces = w3.raw_request(
+                "debug_traceBlockByNumber", [block_identifier, tracer]
+            )
+        else:
+            traces = w3.eth.trace_block(block_identifier, tracer)
+        if traces is None:
+            raise MissingResultError(f"no traces for {block_identifier}")
+        return traces
+
+    try:
+        return call_with_retry(w3, "debug_traceBlockByNumber", fetch)
+    except RetryError as e:
+        logger.error(f"trace block error: {block_identifier}, {e}")
+        return None
 
 
 @dataclass
@@ -33,28 +104,64 @@ class Block:
         txdatas: List[TxData] = None,
         receipts: List[dict] = None,
         traces: List[dict] = None,
+        store: Store = None,
+        header: BlockHeader = None,
     ) -> None:
         self.chain = chain
         self.hash = hash
-        if w3 is None:
-            w3 = make_w3(chain)
-        self.w3 = w3
+        self._w3 = w3
+
+        n = len(txhashes)
+        self.txhashes = txhashes
+        self.txdatas = txdatas if txdatas is not None else [None] * n
+        self.receipts = receipts if receipts is not None else [None] * n
+        self.traces = traces if traces is not None else [None] * n
+        self.store = store
 
-        self.txs = [
+        self.timestamp = timestamp
+        # handed to every TX, so they don't fetch the block again for it
+        self.header = header
+        # payloads which couldn't be fetched, "receipts" and / or "traces", the
+        # txs fetch their own then
+        self.degraded = set()
+
+    @property
+    def w3(self):
+        if self._w3 is None:
+            self._w3 = make_w3(self.chain)
+        return self._w3
+
+    @cached_property
+    def txs(self) -> List[TX]:
+        """TX row views over the block payloads, built on first access"""
+        return [
             TX(
-                chain,
+                self.chain,
                 txhash,
-                w3=self.w3,
+                w3=self._w3,
                 txdata=txdata,
                 receipt=receipt,
                 trace=trace,
+                store=self.store,
+                header=self.header,
             )
             for txhash, txdata, receipt, trace in zip(
-                txhashes, txdatas, receipts, traces
+                self.txhashes, self.txdatas, self.receipts, self.traces
             )
         ]
 
-        self.timestamp = timestamp
+    @cached_property
+    def columns(self) -> BlockColumns:
+        return self.to_columns()
+
+    def to_columns(self, addresses: AddressTable = None) -> BlockColumns:
+        """
+        :param addresses: share one table between blocks to concat their columns
+        """
+        txdatas = self.txdatas
+        if any(txdata is None for txdata in txdatas):
+            txdatas = [tx.txdata for tx in self.txs]
+        return BlockColumns.from_txs(txdatas, self.receipts, addresses)
 
     @classmethod
     def from_w3(
@@ -65,63 +172,126 @@ class Block:
         need_txdatas=True,
         need_receipts=True,
         need_traces=True,
+        executor: Executor = None,
+        store: Store = None,
     ):
+        """
+        :param w3: with make_w3(raw=True) payloads are RawViews, read lazily
+        :param executor: when given, block, receipts and traces are fetched in parallel
+        :param store: persistent store to read through before calling the network
+        """
+
+        if type(block_identifier) == int:
+            block_identifier = hex(block_identifier)
 
         key = f"{chain}_{block_identifier}_{need_txdatas}_{need_receipts}_{need_traces}"
-        if cache.has(key):
+        hit = cache.has(key)
+        metrics.record_cache("block", hit)
+        if hit:
             return cache.get(key)
 
         if w3 is None:
             w3 = make_w3(chain)
 
-        if need_txdatas:
-            data = w3.eth.get_block(
-                block_identifier,
-                full_transactions=True,
-            )
-            txhashes = [tx["hash"] for tx in data["transactions"]]
-            txdatas = data["transactions"]
+        is_hash = isinstance(block_identifier, str) and len(block_identifier) == 66
+        by_number = (
+            isinstance(block_identifier, str)
+            and block_identifier.startswith("0x")
+            and not is_hash
+        )
+        block_kind = "block" if need_txdatas else "block_light"
+
+        data = receipts = traces = None
+        fetched = {}
+        if store is not None and (by_number or is_hash):
+            if is_hash:
+                data = store.get(chain, block_kind, hash=block_identifier)
+            else:
+                data = store.get(chain, block_kind, number=int(block_identifier, 16))
+
+        # tags like "latest" may move between calls, resolve the number first
+        if data is None and (executor is None or not by_number):
+            data = _get_block(w3, block_identifier, need_txdatas)
+            fetched[block_kind] = data
+
+        if data is not None:
+            block_identifier = hex(data["number"])
+            if store is not None and need_receipts:
+                receipts = store.get(chain, "receipts", hash=data["hash"])
+            if store is not None and need_traces:
+                traces = store.get(chain, "traces", hash=data["hash"])
+
+        calls = {}
+        if data is None:
+            calls[block_kind] = partial(_get_block, w3, block_identifier, need_txdatas)
+        if need_receipts and receipts is None:
+            calls["receipts"] = partial(_get_receipts, w3, block_identifier)
+        if need_traces and traces is None:
+            calls["traces"] = partial(_get_traces, w3, block_identifier)
+
+        if executor is None:
+            results = {kind: call() for kind, call in calls.items()}
         else:
-            data = w3.eth.get_block(
-                block_identifier,
-                full_transactions=False,
-            )
-            txhashes = [tx for tx in data["transactions"]]
-            txdatas = len(txhashes) * [None]
+            futures = {kind: executor.submit(call) for kind, call in calls.items()}
+            results = {kind: future.result() for kind, future in futures.items()}
+        fetched.update(results)
 
-        if type(block_identifier) == int:
-            block_identifier = hex(block_identifier)
+        data = fetched.get(block_kind, data)
+        receipts = fetched.get("receipts", receipts)
+        traces = fetched.get("traces", traces)
+        number = data["number"]
+        cache.on_block(chain, number, data["hash"], data["parentHash"])
+        header = BlockHeader.from_block(data)
+        cache_header.on_block(chain, number, data["hash"], data["parentHash"])
+        cache_header.set(chain, number, (chain, number), header)
+
+        # only finalized payloads are persisted, so the store never serves orphans
+        if store is not None:
+            heads.refresh(chain, w3)
+            if heads.is_finalized(chain, number):
+                for kind, payload in fetched.items():
+                    if payload is not None:
+                        store.put(chain, kind, number, data["hash"], payload)
+
+        b = cls.from_payloads(
+            chain, data, receipts, traces, w3=w3, store=store, header=header
+        )
+        b.degraded = {
+            kind
+            for kind in ("receipts", "traces")
+            if kind in calls and fetched[kind] is None
+        }
+
+        # degraded blocks aren't cached, the next call tries the payloads again
+        if (by_number or is_hash) and not b.degraded:
+            cache.set(chain, number, key, b)
+        return b
+
+    @classmethod
+    def from_payloads(
+        cls,
+        chain: Chain,
+        data,
+        receipts: list = None,
+        traces: list = None,
+        w3=None,
+        store: Store = None,
+        header: BlockHeader = None,
+    ):
+        """
+        build a Block from fetched payloads, no network access
 
-        receipts = len(txhashes) * [None]
-        if need_receipts:
-            for i in range(5):  # retry 3 times
-                try:
-                    receipts = w3.eth.get_block_receipts(block_identifier)
-                    break
-                except Exception as e:
-                    logger.error(
-                        f"get block receipts error: {block_identifier}, {e}, the {i+1} time"
-                    )
-                    time.sleep(0.5)
-                    continue
-
-        traces = len(txhashes) * [None]
-
-        if need_traces:
-            for i in range(5):  # retry 3 times
-                try:
-                    traces = w3.eth.trace_block(
-                        block_identifier, {"tracer": "callTracer"}
-                    )
-                    break
-                except Exception as e:
-                    logger.error(
-                        f"trace block error: {block_identifier}, {e}, the {i+1} time"
-                    )
-                    time.sleep(0.5)
-                    continue
-
-        b = cls(
+        :param data: block with full transactions or with txhashes only
+        """
+        transactions = data["transactions"]
+        if transactions and isinstance(transactions[0], Mapping):
+            txhashes = [tx["hash"] for tx in transactions]
+            txdatas = transactions
+        else:
+            txhashes = list(transactions)
+            txdatas = None
+
+        return cls(
             chain,
             data["hash"],
             data["timestamp"],
@@ -130,41 +300,83 @@ class Block:
             txdatas=txdatas,
             receipts=receipts,
             traces=traces,
+            store=store,
+            header=header if header is not None else BlockHeader.from_block(data),
         )
 
-        cache.set(key, b)
-        return b
+    @classmethod
+    def from_w3_range(
+        cls,
+        chain: Chain,
+        start: int,
+        end: int,
+        w3=None,
+        concurrency=8,
+        **kwargs,
+    ) -> Iterator["Block"]:
+        """
+        yield blocks start..end-1 in order, fetching up to concurrency blocks ahead
+
+        :param kwargs: need_txdatas, need_receipts, need_traces, store as in from_w3
+        """
+        if w3 is None:
+            w3 = make_w3(chain)
+
+        numbers = iter(range(start, end))
+        blocks_pool = ThreadPoolExecutor(max_workers=concurrency)
+        calls_pool = ThreadPoolExecutor(max_workers=concurrency * 3)
+
+        def submit(number):
+            return blocks_pool.submit(
+                cls.from_w3, chain, number, w3, executor=calls_pool, **kwargs
+            )
+
+        try:
+            pending = deque(submit(n) for n in islice(numbers, concurrency))
+            while pending:
+                block = pending.popleft().result()
+                number = next(numbers, None)
+                if number is not None:
+                    pending.append(submit(number))
+                yield block
+        finally:
+            blocks_pool.shutdown(wait=False, cancel_futures=True)
+            calls_pool.shutdown(wait=False, cancel_futures=True)
 
     @property
     def sender_counts(self):
-        return Counter([tx.sender for tx in self.txs])
+        return self.columns.counts("sender")
 
     @property
     def receiver_counts(self):
-        return Counter([tx.receiver for tx in self.txs])
+        return self.columns.counts("receiver")
 
     @property
     def from_to_counts(self):
-        return Counter([tx.sender + tx.to for tx in self.txs])
+        return Counter(
+            {
+                sender + to: n
+                for (sender, to), n in self.columns.pair_counts("sender", "to").items()
+            }
+        )
+
+    def decode_logs(self, registry: EventRegistry = None) -> list:
+        """decode the logs of all receipts, logs of unknown events are skipped"""
+        if registry is None:
+            registry = default_registry()
+        return registry.decode_logs(log for tx in self.txs for log in tx.logs)
+
+    @cached_property
+    def sandwiches(self) -> List[Sandwich]:
+        return find_sandwiches(self.txs)
 
     @cached_property
     def sandwich_txs(self):
-        """TODO: not ok, some sandwich tx order is not continuous
-        only backrun tx can be sandwich tx"""
+        """frontrun and backrun txhashes of all sandwiches"""
         txs = set()
-
-        for idx, tx in enumerate(self.txs):
-            # check second previous tx
-            if idx < 2:
-                continue
-
-            if not tx.to or not self.txs[idx - 2].to:
-                continue
-
-            if tx.sender + tx.to == self.txs[idx - 2].sender + self.txs[idx - 2].to:
-                txs.add(tx.txhash)
-                txs.add(self.txs[idx - 2].txhash)
-
+        for sandwich in self.sandwiches:
+            txs.add(sandwich.frontrun)
+            txs.add(sandwich.backrun)
         return txs
 
 
@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+
+from cacheout import LRUCache
+from eth_typing import ChecksumAddress
+from web3 import Web3
+
+PUSH1 = 0x60
+PUSH32 = 0x7F
+
+# eip-1167 minimal proxy, the implementation address sits in between
+MINIMAL_PROXY_PREFIX = bytes.fromhex("363d3d373d3d3d363d73")
+MINIMAL_PROXY_SUFFIX = bytes.fromhex("5af43d82803e903d91602b57fd5bf3")
+
+cache_code_info = LRUCache(maxsize=10000)
+
+
+@dataclass(frozen=True)
+class CodeInfo:
+    code_hash: bytes
+    size: int
+    selectors: frozenset
+    # implementation of an eip-1167 minimal proxy
+    implementation: ChecksumAddress = None
+
+    @property
+    def is_empty(self) -> bool:
+        return self.size == 0
+
+    def has_selectors(self, selectors) -> bool:
+        return self.selectors.issuperset(selectors)
+
+
+def selectors(code: bytes) -> frozenset:
+    """
+    function selectors pushed in code, push data is skipped so selector bytes
+    inside other constants don't count. solc pushes selectors with a leading
+    zero byte with PUSH3, those are padded back to 4 bytes.
+    """
+    found = set()
+    i = 0
+    n = len(code)
+    while i < n:
+        op = code[i]
+        if PUSH1 <= op <= PUSH32:
+            size = op - PUSH1 + 1
+            if size == 4:
+                found.add(code[i + 1 : i + 5])
+            elif size == 3:
+                found.add(b"\x00" + code[i + 1 : i + 4])
+            i += size + 1
+        else:
+            i += 1
+    return frozenset(found)
+
+
+def minimal_proxy_implementation(code: bytes):
+    if (
+        len(code) == 45
+        and code.startswith(MINIMAL_PROXY_PREFIX)
+        and code.endswith(MINIMAL_PROXY_SUFFIX)
+    ):
+        return Web3.to_checksum_address(code[10:30])
+    return None
+
+
+def analyze(code: bytes) -> CodeInfo:
+    """parse code once, cached by code hash so clones share one entry"""
+    code = bytes(code)
+    code_hash = Web3.keccak(code)
+    info = cache_code_info.get(code_hash)
+    if info is None:
+        info = CodeInfo(
+            code_hash=code_hash,
+            size=len(code),
+            selectors=selectors(code),
+            implementation=minimal_proxy_implementation(code),
+        )
+        cache_code_info.set(code_hash, info)
+    return info
@@ -0,0 +1,247 @@
+import threading
+import time
+from collections import defaultdict
+
+from cacheout import Cache, LFUCache
+from web3._utils.caching import generate_cache_key
+from web3.middleware.cache import SIMPLE_CACHE_RPC_WHITELIST
+
+from w3tools.chain import ChainId
+
+# blocks deeper than this below the head are treated as final
+FINALITY_DEPTH = {
+    ChainId.ETH: 64,
+    ChainId.BSC: 15,
+    ChainId.ARB: 64,
+    ChainId.ETH_SEPOLIA: 64,
+}
+DEFAULT_FINALITY_DEPTH = 64
+
+# simple_cache_middleware whitelist without the methods whose result may change
+# with a reorg or while a tx is pending, those go through ReorgAwareCache
+SIMPLE_CACHE_METHODS = tuple(
+    method
+    for method in SIMPLE_CACHE_RPC_WHITELIST
+    if method
+    not in (
+        "eth_getBlockByHash",
+        "eth_getTransactionByHash",
+        "eth_getTransactionByBlockHashAndIndex",
+    )
+)
+
+# method -> index of the block number param, None when only the result knows it
+BLOCK_SCOPED_METHODS = {
+    "eth_getBlockByNumber": 0,
+    "eth_getBlockByHash": None,
+    "eth_getBlockReceipts": 0,
+    "debug_traceBlockByNumber": 0,
+    "eth_getTransactionByHash": None,
+    "eth_getTransactionReceipt": None,
+    "eth_getCode": 1,
+    "eth_getBalance": 1,
+    "eth_getTransactionCount": 1,
+    "eth_getStorageAt": 2,
+    "eth_call": 1,
+}
+
+
+# methods with a block number param which may be a block hash instead
+BLOCK_HASH_METHODS = {"eth_getBlockReceipts"}
+
+
+def to_block_number(value):
+    """int for block numbers, None for tags ("latest", ...) and block hashes"""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.startswith("0x") and len(value) < 66:
+        return int(value, 16)
+    return None
+
+
+class HeadTracker:
+    """latest known head number per chain, refreshed at most every ttl seconds"""
+
+    def __init__(self, ttl=12):
+        self.ttl = ttl
+        self._heads = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def get(self, chain: ChainId):
+        return self._heads.get(chain)
+
+    def update(self, chain: ChainId, number: int, fresh=False):
+        with self._lock:
+            self._heads[chain] = max(self._heads.get(chain, 0), number)
+            if fresh:
+                self._updated[chain] = time.monotonic()
+
+    def is_stale(self, chain: ChainId):
+        return time.monotonic() - self._updated.get(chain, 0) > self.ttl
+
+    def refresh(self, chain: ChainId, w3):
+        if self.is_stale(chain):
+            self.update(chain, w3.eth.block_number, fresh=True)
+        return self._heads[chain]
+
+    def is_finalized(self, chain: ChainId, number: int) -> bool:
+        head = self._heads.get(chain)
+        if head is None or number is None:
+            return False
+        return number <= head - FINALITY_DEPTH.get(chain, DEFAULT_FINALITY_DEPTH)
+
+
+heads = HeadTracker()
+
+
+class ReorgAwareCache:
+    """
+    cache which keeps finalized entries until they are evicted by size, and gives
+    entries near the head a short ttl.
+
+    Every unfinalized entry is indexed by its block number. on_block remembers the
+    hash and parent hash of unfinalized blocks, and when a new block doesn't line
+    up with them, every entry from the fork point on is evicted.
+    """
+
+    def __init__(self, maxsize=10000, head_ttl=12, tracker: HeadTracker = heads):
+        self.tracker = tracker
+        self.finalized = LFUCache(maxsize=maxsize)
+        self.unfinalized = Cache(maxsize=maxsize, ttl=head_ttl)
+        self._blocks = {}  # (chain, number) -> (hash, parent_hash)
+        self._keys = defaultdict(set)  # (chain, number) -> keys
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        value = self.finalized.get(key)
+        if value is None:
+            value = self.unfinalized.get(key)
+        return default if value is None else value
+
+    def has(self, key) -> bool:
+        return self.finalized.has(key) or self.unfinalized.has(key)
+
+    def clear(self):
+        with self._lock:
+            self.finalized.clear()
+            self.unfinalized.clear()
+            self._blocks.clear()
+            self._keys.clear()
+
+    def set(self, chain: ChainId, number: int, key, value):
+        if self.tracker.is_finalized(chain, number):
+            self.finalized.set(key, value)
+            return
+        with self._lock:
+            self.unfinalized.set(key, value)
+            self._keys[(chain, number)].add(key)
+
+    def on_block(self, chain: ChainId, number: int, hash, parent_hash) -> bool:
+        """record a block, evict entries replaced by a reorg, return True on reorg"""
+        self.tracker.update(chain, number)
+        if self.tracker.is_finalized(chain, number):
+            return False
+
+        with self._lock:
+            fork = None
+            known = self._blocks.get((chain, number))
+            parent = self._blocks.get((chain, number - 1))
+            child = self._blocks.get((chain, number + 1))
+            if parent is not None and parent[0] != parent_hash:
+                fork = number - 1
+            elif known is not None and known[0] != hash:
+                fork = number
+            elif child is not None and child[1] != hash:
+                fork = number + 1
+
+            if fork is not None:
+                self.evict_from(chain, fork)
+            self._blocks[(chain, number)] = (hash, parent_hash)
+            self._prune(chain)
+            return fork is not None
+
+    def evict_from(self, chain: ChainId, number: int):
+        """drop every unfinalized entry at and above number"""
+        with self._lock:
+            for chain_number in [k for k in self._keys if k[0] == chain]:
+                if chain_number[1] >= number:
+                    for key in self._keys.pop(chain_number):
+                        self.unfinalized.delete(key)
+            for chain_number in [k for k in self._blocks if k[0] == chain]:
+                if chain_number[1] >= number:
+                    del self._blocks[chain_number]
+
+    def _prune(self, chain: ChainId):
+        # finalized blocks can't be reorged anymore, stop tracking them
+        for chain_number in [k for k in self._blocks if k[0] == chain]:
+            if self.tracker.is_finalized(chain, chain_number[1]):
+                del self._blocks[chain_number]
+                self._keys.pop(chain_number, None)
+
+
+def construct_reorg_cache_middleware(chain: ChainId, cache: ReorgAwareCache = None):
+    """
+    cache block scoped methods with ReorgAwareCache, requests at tags like
+    "latest" and pending txs are never cached
+    """
+    if cache is None:
+        cache = ReorgAwareCache()
+
+    def reorg_cache_middleware(make_request, w3):
+        def middleware(method, params):
+            if method not in BLOCK_SCOPED_METHODS:
+                response = make_request(method, params)
+                if method == "eth_blockNumber" and "result" in response:
+                    cache.tracker.update(chain, int(response["result"], 16), fresh=True)
+                return response
+
+            index = BLOCK_SCOPED_METHODS[method]
+            number = None
+            if index is not None:
+                if len(params) <= index:
+                    return make_request(method, params)
+                number = to_block_number(params[index])
+                # eth_getBlockReceipts also takes a block hash, its result tells
+                # the number. State reads at a block hash (eip-1898) have results
+                # which don't, they aren't cached
+                if number is None and not (
+                    method in BLOCK_HASH_METHODS
+                    and isinstance(params[index], str)
+                    and len(params[index]) == 66
+                ):
+                    return make_request(method, params)
+
+            key = generate_cache_key((chain, method, params))
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+            if cache.tracker.is_stale(chain):
+                head = make_request("eth_blockNumber", [])
+                if "result" in head:
+                    cache.tracker.update(chain, int(head["result"], 16), fresh=True)
+
+            response = make_request(method, params)
+            result = response.get("result")
+            if "error" in response or not result:
+                return response
+
+            if number is None:
+                if isinstance(result, list) and isinstance(result[0], dict):
+                    number = to_block_number(result[0].get("blockNumber"))
+                elif isinstance(result, dict):
+                    number = to_block_number(
+                        result.get("number") or result.get("blockNumber")
+                    )
+                if number is None:  # pending
+                    return response
+
+            if method in ("eth_getBlockByNumber", "eth_getBlockByHash"):
+                cache.on_block(chain, number, result["hash"], result["parentHash"])
+            cache.set(chain, number, key, response)
+            return response
+
+        return middleware
+
+    return reorg_cache_middleware
@@ -0,0 +1,212 @@
+import atexit
+import gzip
+import json
+import os
+import threading
+
+from loguru import logger
+from web3.providers.base import JSONBaseProvider
+
+from w3tools.provider import make_batch_request
+from w3tools.raw import loads
+
+MODES = ("record", "replay", "hybrid")
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def _normalize(value):
+    # hex is case insensitive, checksummed and lowercase addresses are one key
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    return value
+
+
+def request_key(method, params) -> str:
+    return json.dumps(
+        [method, _normalize(list(params or []))], separators=(",", ":"), sort_keys=True
+    )
+
+
+class Cassette:
+    """
+    recorded json-rpc responses keyed by method and params.
+
+    files are gzipped json lines of [method, params, response], where response is
+    the json-rpc response without jsonrpc and id, so recorded errors replay too.
+    Responses are held serialized and parsed again on every get.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.responses = {}
+        self.head = None
+        self._numbers = set()
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def __contains__(self, key):
+        return key in self.responses
+
+    def numbers(self) -> set:
+        """numbers of the recorded blocks"""
+        return set(self._numbers)
+
+    def get(self, method, params) -> dict:
+        """a fresh copy of the recorded response, None when there is none"""
+        response = self.responses.get(request_key(method, params))
+        return None if response is None else loads(response)
+
+    def put(self, method, params, response: dict):
+        response = {k: v for k, v in response.items() if k not in ("jsonrpc", "id")}
+        # kept serialized: compact, and safe from middlewares mutating responses
+        data = json.dumps(response, separators=(",", ":"))
+        with self._lock:
+            self.responses[request_key(method, params)] = data
+            self._dirty = True
+        if method in ("eth_getBlockByNumber", "eth_getBlockByHash"):
+            result = response.get("result")
+            if result:
+                number = int(result["number"], 16)
+                self._numbers.add(number)
+                self.head = max(self.head or 0, number)
+
+    def put_result(self, method, params, result):
+        self.put(method, params, {"result": result})
+
+    @classmethod
+    def load(cls, path) -> "Cassette":
+        fixtures = cls(path)
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                method, params, response = loads(line)
+                fixtures.put(method, params, response)
+        fixtures._dirty = False
+        return fixtures
+
+    def save(self, path):
+        with self._lock:
+            items = list(self.responses.items())
+        with gzip.open(path, "wb") as f:
+            for key, response in items:
+                # key is [method, params], the line is [method, params, response]
+                f.write(f"{key[:-1]},{response}]\n".encode())
+
+    def flush(self):
+        """save to path when anything was recorded since it was loaded or saved"""
+        with self._lock:
+            if not self._dirty or self.path is None:
+                return
+            self._dirty = False
+        self.save(self.path)
+        logger.debug(f"saved {len(self)} responses to {self.path}")
+
+
+# path -> Cassette, every provider of one file records to the same cassette
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def open_cassette(path) -> Cassette:
+    """
+    the cassette of path, loaded on first use and shared within the process, so
+    clients of one file don't overwrite each other's recordings at exit
+    """
+    key = os.path.abspath(path)
+    with _cassettes_lock:
+        cassette = _cassettes.get(key)
+        if cassette is None:
+            if os.path.exists(path):
+                cassette = Cassette.load(path)
+            else:
+                cassette = Cassette(path)
+            _cassettes[key] = cassette
+            atexit.register(cassette.flush)
+        return cassette
+
+
+class CassetteProvider(JSONBaseProvider):
+    """
+    records json-rpc traffic of a provider to a cassette and replays it.
+
+    record: every request goes to the provider, successful responses are recorded
+    replay: requests are answered from the cassette only, a miss raises CassetteMiss
+    hybrid: answered from the cassette, misses go to the provider and are recorded
+
+    error responses are never recorded, so rate limits don't end up in cassettes.
+    The cassette file is loaded when it exists and written by save, which also
+    runs at exit. Providers of the same file share one cassette (open_cassette).
+    """
+
+    def __init__(self, provider=None, path=None, mode="hybrid"):
+        super().__init__()
+        if mode not in MODES:
+            raise ValueError(f"unknown cassette mode: {mode}")
+        if provider is None and mode != "replay":
+            raise ValueError(f"a provider is needed to {mode}")
+        self.provider = provider
+        self.path = path
+        self.mode = mode
+        self.cassette = Cassette() if path is None else open_cassette(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"cassette {self.path} ({self.mode}) over {self.provider}"
+
+    def save(self):
+        self.cassette.flush()
+
+    def _lookup(self, method, params):
+        if self.mode == "record":
+            return None
+        response = self.cassette.get(method, params)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if response is None and self.mode == "replay":
+            raise CassetteMiss(f"{method} {params} is not in {self.path}")
+        return response
+
+    def _record(self, method, params, response):
+        if "error" in response or "result" not in response:
+            return
+        self.cassette.put(method, params, response)
+
+    def make_request(self, method, params):
+        recorded = self._lookup(method, params)
+        if recorded is not None:
+            return {"jsonrpc": "2.0", "id": next(self.request_counter), **recorded}
+        response = self.provider.make_request(method, params)
+        self._record(method, params, response)
+        return response
+
+    def make_batch_request(self, requests, batch_size=None):
+        responses = [None] * len(requests)
+        missing = []
+        for i, (method, params) in enumerate(requests):
+            recorded = self._lookup(method, params)
+            if recorded is None:
+                missing.append(i)
+            else:
+                responses[i] = {"jsonrpc": "2.0", "id": i, **recorded}
+        if missing:
+            fetched = make_batch_request(
+                self.provider, [requests[i] for i in missing], batch_size
+            )
+            for i, response in zip(missing, fetched):
+                self._record(*requests[i], response)
+                responses[i] = response
+        return responses
@@ -0,0 +1,135 @@
+from array import array
+from collections import Counter
+
+NO_SELECTOR = -1
+UNKNOWN_STATUS = -1
+
+
+class AddressTable:
+    """interns addresses to small ints, share one table to compare many blocks"""
+
+    def __init__(self):
+        self.addresses = [""]  # 0 is the empty address, e.g. contract creation
+        self.ids = {"": 0}
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def intern(self, address) -> int:
+        address = address or ""
+        id = self.ids.get(address)
+        if id is None:
+            id = self.ids[address] = len(self.addresses)
+            self.addresses.append(address)
+        return id
+
+    def __getitem__(self, id) -> str:
+        return self.addresses[id]
+
+
+class BlockColumns:
+    """
+    columnar view of txs, one array per field with addresses interned.
+
+    aggregations run over flat arrays instead of TX objects and AttributeDicts,
+    concat joins many blocks into one view for analytics over ranges.
+    value is a list because wei amounts overflow 64 bits.
+    """
+
+    def __init__(self, addresses: AddressTable = None):
+        self.addresses = addresses if addresses is not None else AddressTable()
+        self.sender = array("I")
+        self.to = array("I")
+        self.receiver = array("I")
+        self.value = []
+        self.gas = array("Q")
+        self.gas_price = array("Q")
+        self.gas_used = array("Q")
+        self.status = array("b")
+        self.selector = array("q")
+
+    def __len__(self):
+        return len(self.sender)
+
+    @classmethod
+    def from_txs(cls, txdatas, receipts=None, addresses: AddressTable = None):
+        columns = cls(addresses)
+        if receipts is None:
+            receipts = [None] * len(txdatas)
+        for txdata, receipt in zip(txdatas, receipts):
+            columns.append(txdata, receipt)
+        return columns
+
+    @classmethod
+    def concat(cls, columns_list) -> "BlockColumns":
+        """join columns which share one AddressTable"""
+        columns_list = list(columns_list)
+        columns = cls(columns_list[0].addresses if columns_list else None)
+        for other in columns_list:
+            if other.addresses is not columns.addresses:
+                raise ValueError("columns must share one AddressTable")
+            for name in ("sender", "to", "receiver", "gas", "gas_price", "gas_used"):
+                getattr(columns, name).extend(getattr(other, name))
+            columns.status.extend(other.status)
+            columns.selector.extend(other.selector)
+            columns.value.extend(other.value)
+        return columns
+
+    def append(self, txdata, receipt=None):
+        intern = self.addresses.intern
+        to = txdata["to"] or ""
+        self.sender.append(intern(txdata["from"]))
+        self.to.append(intern(to))
+        if to or receipt is None:
+            self.receiver.append(self.to[-1])
+        else:
+            self.receiver.append(intern(receipt["contractAddress"]))
+        self.value.append(txdata["value"])
+        self.gas.append(txdata["gas"])
+        self.gas_price.append(txdata.get("gasPrice", 0))
+        tx_input = txdata["input"]
+        if len(tx_input) >= 4 and not isinstance(tx_input, str):
+            self.selector.append(int.from_bytes(tx_input[:4], "big"))
+        else:
+            self.selector.append(NO_SELECTOR)
+        if receipt is None:
+            self.gas_used.append(0)
+            self.status.append(UNKNOWN_STATUS)
+        else:
+            self.gas_used.append(receipt["gasUsed"])
+            self.status.append(receipt["status"])
+
+    ## aggregations
+    def counts(self, column="sender") -> Counter:
+        """tx count per address of an address column"""
+        addresses = self.addresses
+        return Counter(
+            {addresses[id]: n for id, n in Counter(getattr(self, column)).items()}
+        )
+
+    def pair_counts(self, first="sender", second="to") -> Counter:
+        """tx count per (first, second) address pair"""
+        addresses = self.addresses
+        pairs = Counter(zip(getattr(self, first), getattr(self, second)))
+        return Counter({(addresses[a], addresses[b]): n for (a, b), n in pairs.items()})
+
+    def selector_counts(self) -> Counter:
+        return Counter(s for s in self.selector if s != NO_SELECTOR)
+
+    def sums(self, column="value", by="sender") -> Counter:
+        """sum of a numeric column per address of an address column"""
+        totals = Counter()
+        for id, amount in zip(getattr(self, by), getattr(self, column)):
+            totals[id] += amount
+        addresses = self.addresses
+        return Counter({addresses[id]: amount for id, amount in totals.items()})
+
+    def fees(self) -> list:
+        return [price * used for price, used in zip(self.gas_price, self.gas_used)]
+
+    def total_fee(self) -> int:
+        return sum(map(int.__mul__, self.gas_price, self.gas_used))
+
+    def failed(self) -> list:
+        """indexes of failed txs"""
+        return [i for i, status in enumerate(self.status) if status == 0]
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+from typing import Callable, List
+
+from loguru import logger
+
+from w3tools import block as block_module
+from w3tools.block import Block
+from w3tools.chain import ChainId
+from w3tools.raw import raw_request
+from w3tools.retry import MissingResultError
+from w3tools.store import Store, _hex
+from w3tools.tx import TX, cache_header
+from w3tools.w3 import WSClient, make_w3
+
+
+class Checkpoint:
+    """
+    last processed block and the hashes of the blocks before it, in a json file.
+
+    the hashes are what a reorg is rolled back against, so up to max_rollback
+    blocks are kept. Files are replaced atomically, a crash leaves the old one.
+    """
+
+    def __init__(self, path, max_rollback=128):
+        self.path = path
+        self.max_rollback = max_rollback
+        self.hashes = {}  # number -> hash
+
+    @property
+    def number(self):
+        return max(self.hashes) if self.hashes else None
+
+    def load(self, chain: ChainId) -> bool:
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        if data["chain"] != int(chain):
+            raise ValueError(f"checkpoint {self.path} is for chain {data['chain']}")
+        self.hashes = {int(n): h for n, h in data["hashes"].items()}
+        return True
+
+    def save(self, chain: ChainId):
+        if self.path is None:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"chain": int(chain), "hashes": self.hashes}, f)
+        os.replace(tmp, self.path)
+
+    def add(self, number: int, hash):
+        self.hashes[number] = _hex(hash)
+        for n in [n for n in self.hashes if n <= number - self.max_rollback]:
+            del self.hashes[n]
+
+    def rollback(self, number: int):
+        """forget blocks above number"""
+        for n in [n for n in self.hashes if n > number]:
+            del self.hashes[n]
+
+
+class ChainFollower:
+    """
+    follows the chain head and hands every block, tx and log to handlers.
+
+    newHeads on ws (when given) wakes the follower as soon as a block arrives,
+    polling block_number every poll_interval seconds is the fallback. Blocks up to
+    head - confirmations are fetched in order with Block.from_w3_range.
+    When a block doesn't extend the last processed one, the follower walks back to
+    the fork point, calls the rollback handlers with it and carries on from there.
+    The checkpoint is saved after every block, so a restart resumes after the last
+    fully handled block. Handlers that raise stop the block, it is retried later.
+
+    e.g.
+        follower = ChainFollower(ChainId.ETH, checkpoint="eth.json", confirmations=2)
+        follower.on_tx(lambda tx: print(tx.txhash))
+        asyncio.run(follower.run())
+
+    :param start: first block when there is no checkpoint, defaults to the head
+    :param checkpoint: checkpoint file, None to keep it in memory only
+    :param confirmations: blocks to stay behind the head
+    :param concurrency: blocks fetched ahead
+    :param kwargs: need_txdatas, need_receipts, need_traces, store as in Block.from_w3
+    """
+
+    def __init__(
+        self,
+        chain: ChainId,
+        w3=None,
+        ws: WSClient = None,
+        start: int = None,
+        checkpoint="checkpoint.json",
+        confirmations=0,
+        concurrency=8,
+        poll_interval=3,
+        max_rollback=128,
+        **kwargs,
+    ):
+        self.chain = chain
+        if w3 is None:
+            w3 = make_w3(chain)
+        self.w3 = w3
+        self.ws = ws
+        self.start = start
+        self.checkpoint = Checkpoint(checkpoint, max_rollback)
+        self.confirmations = confirmations
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.kwargs = kwargs
+        self.store: Store = kwargs.get("store")
+
+        self.block_handlers: List[Callable[[Block], None]] = []
+        self.tx_handlers: List[Callable[[TX], None]] = []
+        self.log_handlers: List[Callable[[dict], None]] = []
+        self.rollback_handlers: List[Callable[[int], None]] = []
+
+        self.head = None
+        self._first = None  # start when there is no checkpoint yet
+        self._loaded = False
+        self._new_head = None
+
+    ## handlers, usable as decorators
+    def on_block(self, handler):
+        self.block_handlers.append(handler)
+        return handler
+
+    def on_tx(self, handler):
+        self.tx_handlers.append(handler)
+        return handler
+
+    def on_log(self, handler):
+        self.log_handlers.append(handler)
+        return handler
+
+    def on_rollback(self, handler):
+        """handler(number) is called with the fork point, blocks above it are gone"""
+        self.rollback_handlers.append(handler)
+        return handler
+
+    @property
+    def next_number(self):
+        number = self.checkpoint.number
+        return None if number is None else number + 1
+
+    def _load(self):
+        """resume from the checkpoint, or start at start (the head by default)"""
+        if self._loaded:
+            return
+        if not self.checkpoint.load(self.chain):
+            self._first = self.start
+            if self._first is None:
+                self._first = self.w3.eth.block_number - self.confirmations
+        self._loaded = True
+
+    async def run(self):
+        self._new_head = asyncio.Event()
+        if self.ws is not None:
+            await self.ws.subscribe("newHeads", self._on_new_head)
+        await asyncio.to_thread(self._load)
+
+        while True:
+            # cleared before the head is read, heads announced during the sync
+            # wake the next round right away
+            self._new_head.clear()
+            try:
+                head = await asyncio.to_thread(lambda: self.w3.eth.block_number)
+                self.head = max(self.head or 0, head)
+                await asyncio.to_thread(self.sync_to, self.head - self.confirmations)
+            except Exception as e:
+                logger.error(
+                    f"follow {self.chain} failed: {e}, next: {self.next_number}"
+                )
+            try:
+                await asyncio.wait_for(self._new_head.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_new_head(self, message):
+        number = int(json.loads(message)["params"]["result"]["number"], 16)
+        self.head = max(self.head or 0, number)
+        self._new_head.set()
+
+    def sync_to(self, end: int):
+        """process blocks from the checkpoint up to end, inclusive"""
+        self._load()
+        while True:
+            start = self.next_number or self._first
+            if start is None or start > end:
+                return
+            blocks = Block.from_w3_range(
+                self.chain,
+                start,
+                end + 1,
+                w3=self.w3,
+                concurrency=self.concurrency,
+                **self.kwargs,
+            )
+            try:
+                for block in blocks:
+                    if not self._extends(block):
+                        self._rollback(block.header.number - 1)
+                        break
+                    self._handle(block)
+                    self.checkpoint.add(block.header.number, block.hash)
+                    self.checkpoint.save(self.chain)
+                    self._first = None
+                else:
+                    return
+            finally:
+                blocks.close()
+
+    def _extends(self, block: Block) -> bool:
+        parent = self.checkpoint.hashes.get(block.header.number - 1)
+        return parent is None or parent == _hex(block.header.parent_hash)
+
+    def _rollback(self, number: int):
+        """walk back from number to the last block still on the canonical chain"""
+        fork = number
+        while fork in self.checkpoint.hashes:
+            # skip the caches, they may still hold the orphaned block
+            canonical = raw_request(self.w3, "eth_getBlockByNumber", [hex(fork), False])
+            if canonical is None:
+                # behind us, e.g. another node behind a load balancer, try later
+                raise MissingResultError(f"no block {fork}, the node is behind")
+            if _hex(canonical["hash"]) == self.checkpoint.hashes[fork]:
+                break
+            fork -= 1
+        else:
+            raise RuntimeError(
+                f"reorg deeper than {self.checkpoint.max_rollback} blocks at {number}"
+            )
+
+        logger.warning(f"reorg on {self.chain}, rollback to {fork}")
+        self.checkpoint.rollback(fork)
+        self.checkpoint.save(self.chain)
+        block_module.cache.evict_from(self.chain, fork + 1)
+        cache_header.evict_from(self.chain, fork + 1)
+        # the middleware cache would hand the orphans back to from_w3_range
+        if getattr(self.w3, "reorg_cache", None) is not None:
+            self.w3.reorg_cache.evict_from(self.chain, fork + 1)
+        if self.store is not None:
+            self.store.delete(self.chain, fork + 1)
+        for handler in self.rollback_handlers:
+            handler(fork)
+
+    def _handle(self, block: Block):
+        for handler in self.block_handlers:
+            handler(block)
+        if not self.tx_handlers and not self.log_handlers:
+            return
+        for tx in block.txs:
+            for handler in self.tx_handlers:
+                handler(tx)
+            if self.log_handlers:
+                for log in tx.logs:
+                    for handler in self.log_handlers:
+                        handler(log)
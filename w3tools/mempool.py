@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+from cacheout import LRUCache
+from loguru import logger
+
+from w3tools.chain import ChainId
+from w3tools.provider import format_result
+from w3tools.tx import TX
+from w3tools.w3 import WSClient, make_w3
+
+
+class PendingTxStream:
+    """
+    newPendingTransactions -> deduped micro-batches -> hydrated TX objects.
+
+    Hashes already seen (bounded by seen_size) are skipped, the rest are collected
+    into batches of batch_size, or whatever arrived within batch_delay seconds, and
+    hydrated with one json-rpc batch each, max_inflight batches at a time.
+    With full_transactions the provider pushes full txs (geth style
+    ["newPendingTransactions", true]) and no hydration is needed, hashes are still
+    hydrated if the provider ignores the flag.
+
+    callback receives each TX, it may be sync or async.
+    """
+
+    def __init__(
+        self,
+        chain: ChainId,
+        ws: WSClient,
+        callback,
+        w3=None,
+        batch_size=100,
+        batch_delay=0.05,
+        max_inflight=4,
+        seen_size=100000,
+        full_transactions=False,
+    ):
+        self.chain = chain
+        self.ws = ws
+        self.callback = callback
+        if w3 is None:
+            w3 = make_w3(chain)
+        self.w3 = w3
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_inflight = max_inflight
+        self.full_transactions = full_transactions
+        self.seen = LRUCache(maxsize=seen_size)
+        self._hashes = []
+        self._full = None
+        self._inflight = None
+
+    async def run(self):
+        self._full = asyncio.Event()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        params = [True] if self.full_transactions else []
+        await self.ws.subscribe("newPendingTransactions", self._on_message, *params)
+        flusher = asyncio.create_task(self._flush_loop())
+        try:
+            await self.ws.run_forever()
+        finally:
+            flusher.cancel()
+
+    def _is_new(self, txhash) -> bool:
+        if self.seen.has(txhash):
+            return False
+        self.seen.set(txhash, True)
+        return True
+
+    async def _on_message(self, message):
+        result = json.loads(message)["params"]["result"]
+        if isinstance(result, dict):
+            if not self._is_new(result["hash"]):
+                return
+            txdata = format_result("eth_getTransactionByHash", {"result": result})
+            await self._emit(TX(self.chain, result["hash"], w3=self.w3, txdata=txdata))
+            return
+
+        if not self._is_new(result):
+            return
+        self._hashes.append(result)
+        if len(self._hashes) >= self.batch_size:
+            self._full.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.batch_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            while self._hashes:
+                batch = self._hashes[: self.batch_size]
+                self._hashes = self._hashes[self.batch_size :]
+                await self._inflight.acquire()
+                asyncio.create_task(self._hydrate(batch))
+
+    async def _hydrate(self, txhashes):
+        try:
+            txdatas = await asyncio.to_thread(self._fetch, txhashes)
+            for txhash, txdata in zip(txhashes, txdatas):
+                # dropped or already replaced txs come back empty
+                if txdata is not None:
+                    await self._emit(TX(self.chain, txhash, w3=self.w3, txdata=txdata))
+        except Exception as e:
+            logger.error(f"hydrate pending txs failed: {e}, size: {len(txhashes)}")
+        finally:
+            self._inflight.release()
+
+    def _fetch(self, txhashes):
+        with self.w3.batch() as batch:
+            for txhash in txhashes:
+                batch.add("eth_getTransactionByHash", [txhash])
+        return batch.results
+
+    async def _emit(self, tx: TX):
+        try:
+            result = self.callback(tx)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.error(f"pending tx callback error: {e}, txhash: {tx.txhash}")
@@ -0,0 +1,293 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from urllib.parse import urlparse
+
+# seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """latency counts per bucket (not cumulative), the last bucket is +Inf"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        """upper bound of the bucket holding the q quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def endpoint_label(provider) -> str:
+    """host of the endpoint provider sends to, never the path (api keys live there)"""
+    while hasattr(provider, "provider"):  # CassetteProvider
+        provider = provider.provider
+    last_call = getattr(provider, "last_call", None)
+    if last_call is not None:  # PooledHTTPProvider
+        uri = last_call()[0]
+    else:
+        uri = getattr(provider, "endpoint_uri", None)
+    if not uri:
+        return type(provider).__name__
+    parsed = urlparse(str(uri))
+    if not parsed.hostname:
+        return str(uri)
+    return f"{parsed.hostname}:{parsed.port}" if parsed.port else parsed.hostname
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+
+class Metrics:
+    """
+    in-process rpc and cache metrics.
+
+    rpc calls are recorded per (method, endpoint): count, errors, retries, response
+    bytes and a latency histogram. Rate limiter waits are recorded per method and
+    cache lookups per cache name. snapshot() returns plain dicts, to_prometheus()
+    the prometheus text format.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = defaultdict(int)
+            self.errors = defaultdict(int)
+            self.retries = defaultdict(int)
+            self.response_bytes = defaultdict(int)
+            self.latency = defaultdict(lambda: Histogram(self.buckets))
+            self.rate_limit_waits = defaultdict(int)
+            self.rate_limit_wait_seconds = defaultdict(float)
+            self.cache_hits = defaultdict(int)
+            self.cache_misses = defaultdict(int)
+
+    def record_call(self, method, endpoint, elapsed, size=0, error=False):
+        key = (method, endpoint)
+        with self._lock:
+            self.calls[key] += 1
+            self.latency[key].observe(elapsed)
+            self.response_bytes[key] += size
+            if error:
+                self.errors[key] += 1
+
+    def record_retry(self, method, endpoint, retries=1):
+        with self._lock:
+            self.retries[(method, endpoint)] += retries
+
+    def record_rate_limit_wait(self, method, wait):
+        with self._lock:
+            self.rate_limit_waits[method] += 1
+            self.rate_limit_wait_seconds[method] += wait
+
+    def record_cache(self, name, hit: bool, count=1):
+        with self._lock:
+            if hit:
+                self.cache_hits[name] += count
+            else:
+                self.cache_misses[name] += count
+
+    def record_batch(self, requests, responses, endpoint, elapsed):
+        """calls sent as one json-rpc batch, the latency is the batch's"""
+        size = sum(getattr(response, "size", 0) for response in responses)
+        with self._lock:
+            for (method, _), response in zip(requests, responses):
+                key = (method, endpoint)
+                self.calls[key] += 1
+                if "error" in response:
+                    self.errors[key] += 1
+            key = ("batch", endpoint)
+            self.calls[key] += 1
+            self.latency[key].observe(elapsed)
+            self.response_bytes[key] += size
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            rpc = {}
+            for key, histogram in self.latency.items():
+                method, endpoint = key
+                rpc.setdefault(method, {})[endpoint] = {
+                    "calls": self.calls[key],
+                    "errors": self.errors.get(key, 0),
+                    "retries": self.retries.get(key, 0),
+                    "response_bytes": self.response_bytes[key],
+                    "latency_sum": histogram.sum,
+                    "latency_p50": histogram.quantile(0.5),
+                    "latency_p99": histogram.quantile(0.99),
+                    "latency_buckets": dict(
+                        zip((*self.buckets, "+Inf"), histogram.counts)
+                    ),
+                }
+            for key, calls in self.calls.items():
+                # batched calls have no latency of their own
+                method, endpoint = key
+                if key not in self.latency:
+                    rpc.setdefault(method, {})[endpoint] = {
+                        "calls": calls,
+                        "errors": self.errors.get(key, 0),
+                        "retries": self.retries.get(key, 0),
+                    }
+            caches = {}
+            for name in self.cache_hits.keys() | self.cache_misses.keys():
+                hits, misses = self.cache_hits[name], self.cache_misses[name]
+                caches[name] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                }
+            return {
+                "rpc": rpc,
+                "rate_limit": {
+                    method: {
+                        "waits": self.rate_limit_waits[method],
+                        "wait_seconds": self.rate_limit_wait_seconds[method],
+                    }
+                    for method in self.rate_limit_waits
+                },
+                "caches": caches,
+            }
+
+    def to_prometheus(self, prefix="w3tools") -> str:
+        lines = []
+
+        def counter(name, help, values, label_names):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for key, value in sorted(values.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                labels = _labels(**dict(zip(label_names, key)))
+                lines.append(f"{prefix}_{name}{{{labels}}} {value}")
+
+        with self._lock:
+            rpc = ("method", "endpoint")
+            counter("rpc_requests_total", "json-rpc calls", self.calls, rpc)
+            counter("rpc_errors_total", "json-rpc error responses", self.errors, rpc)
+            counter("rpc_retries_total", "retried json-rpc calls", self.retries, rpc)
+            counter(
+                "rpc_response_bytes_total",
+                "json-rpc response bytes",
+                self.response_bytes,
+                rpc,
+            )
+
+            name = f"{prefix}_rpc_latency_seconds"
+            lines.append(f"# HELP {name} json-rpc call latency")
+            lines.append(f"# TYPE {name} histogram")
+            for (method, endpoint), histogram in sorted(self.latency.items()):
+                labels = _labels(method=method, endpoint=endpoint)
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+            counter(
+                "rate_limit_waits_total",
+                "requests charged to the rate limiter",
+                self.rate_limit_waits,
+                ("method",),
+            )
+            counter(
+                "rate_limit_wait_seconds_total",
+                "seconds spent waiting for the rate limiter",
+                self.rate_limit_wait_seconds,
+                ("method",),
+            )
+            counter("cache_hits_total", "cache hits", self.cache_hits, ("cache",))
+            counter("cache_misses_total", "cache misses", self.cache_misses, ("cache",))
+        return "\n".join(lines) + "\n"
+
+
+# block, header and address caches always record here, make_w3(metrics=True)
+# records rpc calls here too
+metrics = Metrics()
+
+
+def construct_metrics_middleware(metrics: Metrics):
+    """
+    record every call reaching the provider, inject it innermost so cache hits
+    and rate limiter waits don't count as latency. Response bytes are the http
+    body sizes SizedResponses carry (see raw.sized_decoder), 0 for others
+    """
+
+    def metrics_middleware(make_request, w3):
+        def middleware(method, params):
+            start = time.perf_counter()
+            try:
+                response = make_request(method, params)
+            except Exception:
+                elapsed = time.perf_counter() - start
+                metrics.record_call(
+                    method, endpoint_label(w3.provider), elapsed, 0, True
+                )
+                raise
+            elapsed = time.perf_counter() - start
+            endpoint = endpoint_label(w3.provider)
+            size = getattr(response, "size", 0)
+            metrics.record_call(method, endpoint, elapsed, size, "error" in response)
+            last_call = getattr(w3.provider, "last_call", None)
+            if last_call is not None and last_call()[1]:
+                metrics.record_retry(method, endpoint, last_call()[1])
+            return response
+
+        return middleware
+
+    return metrics_middleware
+
+
+def construct_cache_probe_middlewares(metrics: Metrics, name, methods):
+    """
+    (outer, inner) middlewares to wrap around a caching middleware, every call of
+    methods through outer is a lookup, every one reaching inner is a miss
+    """
+    methods = frozenset(methods)
+    local = threading.local()
+
+    def outer_probe(make_request, w3):
+        def middleware(method, params):
+            if method not in methods:
+                return make_request(method, params)
+            local.missed = False
+            response = make_request(method, params)
+            metrics.record_cache(name, not local.missed)
+            return response
+
+        return middleware
+
+    def inner_probe(make_request, w3):
+        def middleware(method, params):
+            if method in methods:
+                local.missed = True
+            return make_request(method, params)
+
+        return middleware
+
+    return outer_probe, inner_probe
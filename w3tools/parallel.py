@@ -0,0 +1,173 @@
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Iterator
+
+import aiohttp
+
+from w3tools.block import Block
+from w3tools.chain import ChainId
+from w3tools.provider import _decode_batch, encode_batch
+from w3tools.ratelimit import RateLimiter, endpoint_key, get_bucket
+from w3tools.raw import view
+from w3tools.retry import MissingResultError, RetryError, RetryPolicy, default_policy
+from w3tools.rpc import HTTP_PROVIDERS, RPC_PROVIDER
+
+
+def block_requests(
+    number: int, need_txdatas=True, need_receipts=True, need_traces=True
+):
+    block_identifier = hex(number)
+    requests = [("eth_getBlockByNumber", [block_identifier, need_txdatas])]
+    if need_receipts:
+        requests.append(("eth_getBlockReceipts", [block_identifier]))
+    if need_traces:
+        requests.append(
+            ("debug_traceBlockByNumber", [block_identifier, {"tracer": "callTracer"}])
+        )
+    return requests
+
+
+def parse_block(chain: ChainId, raw_response: bytes, need_receipts, need_traces):
+    """Block from the raw bytes of a block_requests batch"""
+    results = []
+    for response in _decode_batch(raw_response, 1 + need_receipts + need_traces):
+        if "error" in response or response.get("result") is None:
+            raise ValueError(f"bad response: {response}")
+        results.append(view(response["result"]))
+    data = results[0]
+    receipts = results[1] if need_receipts else None
+    traces = results[-1] if need_traces else None
+    return Block.from_payloads(chain, data, receipts, traces)
+
+
+def _work(chain, raw_response, need_receipts, need_traces, analyze):
+    # runs in a worker process, only bytes come in and only analyze's result goes out
+    return analyze(parse_block(chain, raw_response, need_receipts, need_traces))
+
+
+async def aprocess_range(
+    chain: ChainId,
+    start: int,
+    end: int,
+    analyze: Callable[[Block], object],
+    provider: RPC_PROVIDER | str = "default",
+    endpoint=None,
+    api_key="",
+    processes=None,
+    concurrency=16,
+    rate_limit=None,
+    method_costs=None,
+    need_txdatas=True,
+    need_receipts=True,
+    need_traces=False,
+    timeout=30,
+    retry: RetryPolicy = None,
+) -> AsyncIterator[object]:
+    """
+    yield analyze(block) for blocks start..end-1 in order.
+
+    Each block is fetched as one json-rpc batch with async io, up to concurrency
+    at a time, and its raw response bytes go to a process pool where they are
+    parsed (RawView, no web3 formatting) and analyzed. Parsing and analytics are
+    pure python, so throughput scales with processes instead of stopping at the GIL.
+
+    :param analyze: picklable (module level) function of a Block, return something
+        compact, it is pickled back from the worker
+    :param processes: worker processes, defaults to the cpu count
+    :param rate_limit: requests (or compute units with method_costs) every second
+    :param retry: retry policy of the block batches, retry.default_policy when not
+        given
+    """
+    if endpoint is None:
+        if isinstance(provider, str):
+            provider = RPC_PROVIDER(provider)
+        endpoint = HTTP_PROVIDERS[chain][provider].format(api_key)
+    retry = retry or default_policy
+    limiter = None
+    if rate_limit:
+        bucket = get_bucket(endpoint_key(endpoint), rate_limit)
+        limiter = RateLimiter(bucket, method_costs)
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session, requests):
+        if limiter is not None:
+            await limiter.acquire_async(*(m for m, _ in requests))
+        async with session.post(
+            endpoint,
+            data=encode_batch(requests),
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            response.raise_for_status()
+            raw_response = await response.read()
+        # json-rpc errors come back inside a 200 batch, check every call here so
+        # they are retried instead of failing the worker
+        for (method, _), rpc_response in zip(
+            requests, _decode_batch(raw_response, len(requests))
+        ):
+            if "error" in rpc_response:
+                raise ValueError(rpc_response["error"])
+            if rpc_response.get("result") is None:
+                raise MissingResultError(method)
+        return raw_response
+
+    async def fetch(session, number):
+        requests = block_requests(number, need_txdatas, need_receipts, need_traces)
+        async with semaphore:
+            try:
+                return await retry.acall("batch", post, session, requests)
+            except RetryError as e:
+                raise RuntimeError(f"fetch block failed: {number}, {e}") from e
+
+    async def process(session, pool, number):
+        raw_response = await fetch(session, number)
+        return await loop.run_in_executor(
+            pool, _work, chain, raw_response, need_receipts, need_traces, analyze
+        )
+
+    processes = processes or os.cpu_count()
+    numbers = iter(range(start, end))
+    pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as session:
+            # keep enough blocks in flight to feed both the network and the pool
+            window = concurrency + processes
+            pending = deque()
+            for number in numbers:
+                pending.append(asyncio.create_task(process(session, pool, number)))
+                if len(pending) >= window:
+                    break
+            try:
+                while pending:
+                    result = await pending.popleft()
+                    number = next(numbers, None)
+                    if number is not None:
+                        pending.append(
+                            asyncio.create_task(process(session, pool, number))
+                        )
+                    yield result
+            finally:
+                for task in pending:
+                    task.cancel()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def process_range(chain: ChainId, start: int, end: int, analyze, **kwargs) -> Iterator:
+    """sync version of aprocess_range, runs its own event loop"""
+    loop = asyncio.new_event_loop()
+    results = aprocess_range(chain, start, end, analyze, **kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
@@ -0,0 +1,443 @@
+"""
+re-run variants of one call locally, in py-evm seeded with the call's prestate.
+
+The prestate (every account and storage slot the call touches) is traced once
+with prestateTracer and cached by block hash and tx, after that each variant
+(other value, gas, sender, input) runs in process without calling the node.
+
+e.g.
+    evm = local_evm(ChainId.ETH, tx)
+    for value in range(0, 10**18, 10**17):
+        result = evm.call({"value": value})  # or tx.simulate_local(value=value)
+
+Variants may read state the traced call never touched, e.g. the token balance
+of another sender. Such accounts and storage slots are fetched from the node at
+the prestate's block (in one batch) and the variant runs again, until it reads
+nothing new. A result is marked inexact when that takes more than
+MAX_LOAD_ROUNDS runs.
+
+For a mined tx the prestate is the state at the tx's position in its block, but
+the node can only serve missing state as of the block before, without the
+writes of the txs in front of it. Results which read such state are marked
+inexact too. Gas isn't paid for and BLOCKHASH is zero, like a bare eth_call.
+
+Only chains with a known py-evm fork (CHAIN_VMS) are supported, pass vm_class
+for others.
+
+needs py-evm: pip install w3tools[sim]
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from cacheout import LRUCache
+from eth_utils import to_canonical_address, to_checksum_address
+from loguru import logger
+from web3._utils.caching import generate_cache_key
+
+from w3tools.chain import ChainId
+from w3tools.tx import TX, BlockHeader, block_param, call_object, get_header
+from w3tools.w3 import make_w3
+
+try:
+    from eth.constants import BLANK_ROOT_HASH
+    from eth.db.atomic import AtomicDB
+    from eth.vm.execution_context import ExecutionContext
+    from eth.vm.forks import CancunVM
+    from eth.vm.message import Message
+
+    # py-evm fork of the current rules of each chain
+    CHAIN_VMS = {ChainId.ETH: CancunVM, ChainId.ETH_SEPOLIA: CancunVM}
+except ImportError:  # pragma: no cover
+    CancunVM = None
+    CHAIN_VMS = {}
+
+PRESTATE_TRACER = {"tracer": "prestateTracer"}
+DEFAULT_GAS = 30_000_000
+# runs of one call which may still discover missing state
+MAX_LOAD_ROUNDS = 8
+
+
+def _int(value) -> int:
+    if value is None:
+        return 0
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+def _bytes(value) -> bytes:
+    if value is None:
+        return b""
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+    return bytes(value)
+
+
+@dataclass
+class Account:
+    balance: int = 0
+    nonce: int = 0
+    code: bytes = b""
+    storage: Dict[int, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_trace(cls, account) -> "Account":
+        return cls(
+            balance=_int(account.get("balance")),
+            nonce=_int(account.get("nonce")),
+            code=_bytes(account.get("code")),
+            storage={
+                _int(slot): _int(value)
+                for slot, value in (account.get("storage") or {}).items()
+            },
+        )
+
+
+@dataclass
+class Prestate:
+    """state a call starts from, in the context of header's block"""
+
+    chain: ChainId
+    header: BlockHeader
+    accounts: Dict[str, Account]
+    # the traced call, as a json-rpc call object
+    call: dict
+    # accounts missing from the trace are read at this block
+    state_block: int
+    # position of the traced tx in header's block, None for calls on top of it
+    tx_index: int = None
+
+    @classmethod
+    def from_trace(
+        cls, chain, header, call, result, state_block, tx_index=None
+    ) -> "Prestate":
+        accounts = {
+            to_checksum_address(address): Account.from_trace(account)
+            for address, account in result.items()
+        }
+        return cls(chain, header, accounts, call, state_block, tx_index)
+
+
+@dataclass
+class SimulationResult:
+    success: bool
+    output: bytes
+    gas_used: int
+    error: str = None
+    # {"address", "topics", "data"}, topics as ints
+    logs: List[dict] = field(default_factory=list)
+    # False when the call still read state missing from the prestate, or state
+    # which had to be read before the txs in front of the traced one
+    exact: bool = True
+
+
+def trace_prestate(chain: ChainId, tx_or_call, block_number=None, w3=None) -> Prestate:
+    """
+    prestate of a mined TX at its position in its block, or of a call (TX or
+    call dict) on top of block_number, "latest" by default
+    """
+    if w3 is None:
+        w3 = make_w3(chain)
+    if (
+        isinstance(tx_or_call, TX)
+        and not tx_or_call.is_pending
+        and block_number is None
+    ):
+        tx = tx_or_call
+        response = w3.provider.make_request(
+            "debug_traceTransaction", [tx.txhash, PRESTATE_TRACER]
+        )
+        number = tx.block_number
+        state_block = number - 1
+        tx_index = tx.txdata["transactionIndex"]
+        call = call_object(tx.as_call())
+    else:
+        if isinstance(tx_or_call, TX):
+            call = call_object(tx_or_call.as_call())
+        else:
+            call = call_object(tx_or_call)
+        number = block_number
+        if number is None or isinstance(number, str):
+            number = w3.eth.get_block(block_number or "latest")["number"]
+        state_block = number
+        tx_index = None
+        response = w3.provider.make_request(
+            "debug_traceCall", [call, block_param(number), PRESTATE_TRACER]
+        )
+    if "error" in response:
+        raise ValueError(response["error"])
+    header = get_header(chain, number, w3)
+    return Prestate.from_trace(
+        chain, header, call, response["result"], state_block, tx_index
+    )
+
+
+def _require_evm(chain, vm_class=None):
+    """the py-evm vm class to simulate chain with"""
+    if CancunVM is None:
+        raise ImportError("local simulation needs py-evm: pip install w3tools[sim]")
+    vm_class = vm_class or CHAIN_VMS.get(chain)
+    if vm_class is None:
+        raise ValueError(f"no py-evm fork known for {chain!r}, pass vm_class")
+    return vm_class
+
+
+class _MissingStateTracker:
+    """
+    state mixin noting reads of accounts and storage slots the prestate doesn't
+    have, they read as empty until LocalEVM loads them
+    """
+
+    def __init__(self, *args, **kwargs):
+        # canonical address -> slots, what reads don't need to load
+        self.seeded = {}
+        self.missing_accounts = set()
+        self.missing_slots = set()
+        # accounts and (address, slot)s loaded as of an earlier state than the
+        # prestate's, see Prestate.tx_index
+        self.unpositioned = set()
+        self.read_unpositioned = False
+        # the state reads system contracts while it is set up
+        super().__init__(*args, **kwargs)
+
+    def _note_account(self, address):
+        if address not in self.seeded:
+            self.missing_accounts.add(address)
+        elif address in self.unpositioned:
+            self.read_unpositioned = True
+
+    def get_storage(self, address, slot, from_journal=True):
+        self._note_account(address)
+        if slot not in self.seeded.get(address, ()):
+            self.missing_slots.add((address, slot))
+        elif (address, slot) in self.unpositioned:
+            self.read_unpositioned = True
+        return super().get_storage(address, slot, from_journal)
+
+    def get_balance(self, address):
+        self._note_account(address)
+        return super().get_balance(address)
+
+    def get_nonce(self, address):
+        self._note_account(address)
+        return super().get_nonce(address)
+
+    def get_code(self, address):
+        self._note_account(address)
+        return super().get_code(address)
+
+    def get_code_hash(self, address):
+        self._note_account(address)
+        return super().get_code_hash(address)
+
+    def account_exists(self, address):
+        self._note_account(address)
+        return super().account_exists(address)
+
+    def account_is_empty(self, address):
+        self._note_account(address)
+        return super().account_is_empty(address)
+
+
+class LocalEVM:
+    """
+    py-evm state built once from a Prestate, every call runs on a snapshot of it
+    and is reverted afterwards, so calls don't see each other's writes. State
+    missing from the prestate is loaded into it as calls read it
+    """
+
+    def __init__(self, prestate: Prestate, w3=None, vm_class=None):
+        self.vm_class = _require_evm(prestate.chain, vm_class)
+        self.prestate = prestate
+        self.chain = prestate.chain
+        self._w3 = w3
+
+        header = prestate.header
+        context = ExecutionContext(
+            coinbase=to_canonical_address(header.miner),
+            timestamp=header.timestamp,
+            block_number=header.number,
+            difficulty=0,
+            mix_hash=b"\x00" * 32,
+            gas_limit=header.gas_limit or DEFAULT_GAS,
+            prev_hashes=(),
+            chain_id=int(self.chain),
+            base_fee_per_gas=header.base_fee or 0,
+            excess_blob_gas=0,
+        )
+        state_class = type(
+            "LazyState", (_MissingStateTracker, self.vm_class.get_state_class()), {}
+        )
+        self.state = state_class(AtomicDB(), context, BLANK_ROOT_HASH)
+        for address, account in prestate.accounts.items():
+            self._set_account(address, account)
+        self.state.persist()
+
+    @property
+    def w3(self):
+        if self._w3 is None:
+            self._w3 = make_w3(self.chain)
+        return self._w3
+
+    @property
+    def base_call(self) -> dict:
+        """the traced call, variants are usually dict(evm.base_call, ...)"""
+        return dict(self.prestate.call)
+
+    def _set_account(self, address, account: Account):
+        canonical = to_canonical_address(address)
+        self.state.set_balance(canonical, account.balance)
+        self.state.set_nonce(canonical, account.nonce)
+        if account.code:
+            self.state.set_code(canonical, account.code)
+        for slot, value in account.storage.items():
+            self.state.set_storage(canonical, slot, value)
+        self.state.seeded.setdefault(canonical, set()).update(account.storage)
+
+    def _ensure_account(self, address):
+        """fetch an account the prestate doesn't have, e.g. a new sender"""
+        if to_checksum_address(address) not in self.prestate.accounts:
+            self._load([to_canonical_address(address)], [])
+
+    def _load(self, addresses, slots):
+        """
+        fetch accounts and (address, slot)s the prestate doesn't have, at its
+        state block in one batch
+        """
+        block = block_param(self.prestate.state_block)
+        addresses = [to_checksum_address(a) for a in addresses]
+        slots = [(to_checksum_address(a), slot) for a, slot in slots]
+        with self.w3.batch() as batch:
+            for address in addresses:
+                batch.add("eth_getBalance", [address, block])
+                batch.add("eth_getTransactionCount", [address, block])
+                batch.add("eth_getCode", [address, block])
+            for address, slot in slots:
+                batch.add("eth_getStorageAt", [address, hex(slot), block])
+        results = batch.results
+        for i, address in enumerate(addresses):
+            balance, nonce, code = results[3 * i : 3 * i + 3]
+            account = Account(balance or 0, nonce or 0, bytes(code or b""))
+            self.prestate.accounts[address] = account
+            self._set_account(address, account)
+        for (address, slot), value in zip(slots, results[3 * len(addresses) :]):
+            value = int.from_bytes(bytes(value or b""), "big")
+            self.prestate.accounts[address].storage[slot] = value
+            canonical = to_canonical_address(address)
+            self.state.set_storage(canonical, slot, value)
+            self.state.seeded[canonical].add(slot)
+        if self.prestate.tx_index:
+            # read before the block, txs in front of the traced one may have
+            # changed them
+            self.state.unpositioned.update(to_canonical_address(a) for a in addresses)
+            self.state.unpositioned.update(
+                (to_canonical_address(a), slot) for a, slot in slots
+            )
+        logger.debug(
+            f"fetched {len(addresses)} accounts and {len(slots)} storage slots "
+            f"for local simulation at {block}"
+        )
+        self.state.persist()
+
+    def call(self, call: dict) -> SimulationResult:
+        """
+        run a call dict (see tx.call_object) on the prestate, missing fields are
+        taken from base_call
+        """
+        payload = dict(self.prestate.call, **call_object(call))
+        if not payload.get("to"):
+            raise ValueError("contract creation can't be simulated locally")
+        self._ensure_account(payload["from"])
+
+        state = self.state
+        for _ in range(MAX_LOAD_ROUNDS):
+            state.missing_accounts.clear()
+            state.missing_slots.clear()
+            state.read_unpositioned = False
+            result = self._apply(payload)
+            if not state.missing_accounts and not state.missing_slots:
+                result.exact = not state.read_unpositioned
+                return result
+            # run again with what the call read and the prestate didn't have
+            self._load(state.missing_accounts, state.missing_slots)
+        logger.warning(
+            f"call still reads state missing from the prestate after "
+            f"{MAX_LOAD_ROUNDS} runs, the result is inexact"
+        )
+        result.exact = False
+        return result
+
+    def _apply(self, payload) -> SimulationResult:
+        to = to_canonical_address(payload["to"])
+        sender = to_canonical_address(payload["from"])
+        snapshot = self.state.snapshot()
+        try:
+            transaction_context = self.state.get_transaction_context_class()(
+                gas_price=_int(payload.get("gasPrice")), origin=sender
+            )
+            message = Message(
+                gas=_int(payload.get("gas")) or DEFAULT_GAS,
+                to=to,
+                sender=sender,
+                value=_int(payload.get("value")),
+                data=_bytes(payload.get("data")),
+                code=self.state.get_code(to),
+            )
+            computation = self.state.computation_class.apply_message(
+                self.state, message, transaction_context
+            )
+            return SimulationResult(
+                success=computation.is_success,
+                output=computation.output,
+                gas_used=computation.get_gas_used(),
+                error=None if computation.is_success else repr(computation.error),
+                logs=[
+                    {
+                        "address": to_checksum_address(address),
+                        "topics": list(topics),
+                        "data": data,
+                    }
+                    for address, topics, data in computation.get_log_entries()
+                ],
+            )
+        finally:
+            self.state.revert(snapshot)
+
+
+# (chain, block hash, tx hash or call) -> LocalEVM, keyed by hash so a reorged
+# block never serves a stale prestate
+cache_evm = LRUCache(maxsize=100)
+
+
+def local_evm(
+    chain: ChainId, tx_or_call, block_number=None, w3=None, vm_class=None
+) -> LocalEVM:
+    """
+    cached LocalEVM for a TX (at its position in its block when mined) or for a
+    call (TX or call dict) on top of block_number, "latest" by default
+
+    :param vm_class: py-evm vm class, CHAIN_VMS[chain] by default
+    """
+    vm_class = _require_evm(chain, vm_class)
+    if w3 is None:
+        w3 = make_w3(chain)
+
+    if (
+        isinstance(tx_or_call, TX)
+        and not tx_or_call.is_pending
+        and block_number is None
+    ):
+        header = get_header(chain, tx_or_call.block_number, w3)
+        key = (chain, header.hash, tx_or_call.txhash)
+    else:
+        call = tx_or_call if isinstance(tx_or_call, dict) else tx_or_call.as_call()
+        if block_number is None or isinstance(block_number, str):
+            block_number = w3.eth.get_block(block_number or "latest")["number"]
+        header = get_header(chain, block_number, w3)
+        key = (chain, header.hash, generate_cache_key(call_object(call)))
+
+    evm = cache_evm.get(key)
+    if evm is None:
+        prestate = trace_prestate(chain, tx_or_call, block_number, w3)
+        evm = LocalEVM(prestate, w3, vm_class)
+        cache_evm.set(key, evm)
+    return evm
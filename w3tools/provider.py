@@ -0,0 +1,531 @@
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from loguru import logger
+from web3._utils.encoding import Web3JsonEncoder
+from web3._utils.method_formatters import PYTHONIC_RESULT_FORMATTERS
+from web3._utils.request import make_post_request
+from web3.datastructures import AttributeDict
+from web3.providers.base import JSONBaseProvider
+from web3.providers.rpc import HTTPProvider
+
+from w3tools.metrics import endpoint_label
+from w3tools.raw import SizedResponse, loads
+
+
+def encode_batch(requests, start_id=0):
+    """encode [(method, params), ...] as one json-rpc batch array"""
+    return json.dumps(
+        [
+            {"jsonrpc": "2.0", "method": method, "params": params or [], "id": i}
+            for i, (method, params) in enumerate(requests, start_id)
+        ],
+        cls=Web3JsonEncoder,
+    ).encode()
+
+
+def make_batch_request(provider, requests, batch_size=None):
+    """
+    send [(method, params), ...] in batches of batch_size, return raw responses in order.
+    batch_size defaults to the provider's own, or 100.
+
+    providers which can't batch (ipc, custom ones without endpoint) fall back to
+    one make_request per call.
+    """
+    if not requests:
+        return []
+    if hasattr(provider, "make_batch_request"):
+        return provider.make_batch_request(requests, batch_size)
+    if not isinstance(provider, HTTPProvider):
+        return [provider.make_request(method, params) for method, params in requests]
+    return post_batch(provider, requests, batch_size or 100)
+
+
+def post_batch(provider: HTTPProvider, requests, batch_size=100):
+    responses = []
+    for i in range(0, len(requests), batch_size):
+        chunk = requests[i : i + batch_size]
+        raw_response = make_post_request(
+            provider.endpoint_uri, encode_batch(chunk), **provider.get_request_kwargs()
+        )
+        responses.extend(_decode_batch(raw_response, len(chunk)))
+    return responses
+
+
+# error code of the calls a batch response left out, not an ENDPOINT_ERROR_CODE:
+# the endpoint may just lack the data
+MISSING_RESPONSE_CODE = -32099
+
+
+def _decode_batch(raw_response, size):
+    """responses in id order, each is a SizedResponse with a share of the body"""
+    responses = loads(raw_response)
+    share = len(raw_response) // max(size, 1)
+    if isinstance(responses, dict):
+        # the whole batch is rejected, e.g. batch too large or rate limited
+        return [SizedResponse(responses, share) for _ in range(size)]
+    by_id = {r.get("id"): r for r in responses}
+    missing = {
+        "jsonrpc": "2.0",
+        "error": {"code": MISSING_RESPONSE_CODE, "message": "missing"},
+    }
+    return [SizedResponse(by_id.get(i, missing), share) for i in range(size)]
+
+
+def format_result(method, response):
+    """apply the same result formatters web3 would, return None on error"""
+    if "error" in response or response.get("result") is None:
+        return None
+    result = response["result"]
+    formatter = PYTHONIC_RESULT_FORMATTERS.get(method)
+    if formatter is not None:
+        result = formatter(result)
+    return AttributeDict.recursive(result)
+
+
+class BatchHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider which coalesces concurrent make_request calls into json-rpc batches.
+
+    A batch is flushed when it reaches batch_size or when the oldest request has waited
+    batch_delay seconds. Only requests issued concurrently (threads) share a batch, a
+    single-threaded caller should use Batch / w3.batch() instead.
+    """
+
+    def __init__(
+        self,
+        endpoint_uri=None,
+        batch_size=50,
+        batch_delay=0.005,
+        max_inflight=4,
+        **kwargs,
+    ):
+        super().__init__(endpoint_uri, **kwargs)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight)
+        self._pending = []
+        self._cond = threading.Condition()
+        self._flusher = None
+
+    def make_request(self, method, params):
+        future = Future()
+        with self._cond:
+            self._pending.append((method, params, future))
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+            self._cond.notify()
+        return future.result()
+
+    def make_batch_request(self, requests, batch_size=None):
+        return post_batch(self, requests, batch_size or self.batch_size)
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.batch_delay
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[: self.batch_size]
+                self._pending = self._pending[self.batch_size :]
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            responses = self.make_batch_request([(m, p) for m, p, _ in batch])
+        except Exception as e:
+            logger.error(f"batch request failed: {e}, size: {len(batch)}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), response in zip(batch, responses):
+            future.set_result(response)
+
+
+class Batch:
+    """
+    explicit json-rpc batch, e.g.
+
+        with w3.batch() as batch:
+            for txhash in txhashes:
+                batch.add("eth_getTransactionByHash", [txhash])
+        txdatas = batch.results
+
+    results are formatted like w3.eth results, failed calls are None.
+    """
+
+    def __init__(self, w3, batch_size=100):
+        self.w3 = w3
+        self.batch_size = batch_size
+        self.requests = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, method, params):
+        self.requests.append((method, params))
+        return len(self.requests) - 1
+
+    def execute(self):
+        limiter = getattr(self.w3, "rate_limiter", None)
+        if limiter is not None:
+            limiter.acquire(*(method for method, _ in self.requests))
+        start = time.perf_counter()
+        responses = make_batch_request(self.w3.provider, self.requests, self.batch_size)
+        metrics = getattr(self.w3, "metrics", None)
+        if metrics is not None and self.requests:
+            metrics.record_batch(
+                self.requests,
+                responses,
+                endpoint_label(self.w3.provider),
+                time.perf_counter() - start,
+            )
+        self.results = []
+        for (method, params), response in zip(self.requests, responses):
+            if "error" in response:
+                logger.warning(f"batch call {method} {params} failed: {response}")
+            self.results.append(format_result(method, response))
+        self.requests = []
+        return self.results
+
+
+# requests which must not be sent twice
+NON_IDEMPOTENT_METHODS = {
+    "eth_sendRawTransaction",
+    "eth_sendTransaction",
+    "eth_sendBundle",
+    "eth_sendPrivateTransaction",
+}
+
+# json-rpc error codes which mean the endpoint, not the request, is the problem
+ENDPOINT_ERROR_CODES = {-32005, -32603, 429}
+
+
+class Endpoint:
+    """health of one pool member, latency and error rate are moving averages"""
+
+    def __init__(self, provider, alpha=0.2, failure_threshold=3, cooldown=30):
+        self.provider = provider
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = 0.1
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def __str__(self):
+        return str(self.provider.endpoint_uri)
+
+    @property
+    def score(self) -> float:
+        """lower is better"""
+        return self.latency * (1 + 10 * self.error_rate)
+
+    def is_available(self, now) -> bool:
+        # once the cooldown is over the breaker is half-open, one failure re-opens it
+        return self.open_until <= now
+
+    def record_success(self, elapsed):
+        self.latency += self.alpha * (elapsed - self.latency)
+        self.error_rate -= self.alpha * self.error_rate
+        self.failures = 0
+
+    def record_failure(self):
+        self.error_rate += self.alpha * (1 - self.error_rate)
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            # back off longer the more often the endpoint keeps failing
+            backoff = self.cooldown * 2 ** (self.failures - self.failure_threshold)
+            self.open_until = time.monotonic() + min(backoff, 600)
+            logger.warning(f"endpoint {self} ejected for {backoff}s")
+
+
+def is_endpoint_error(response) -> bool:
+    error = response.get("error")
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get("message", "")).lower()
+    return (
+        error.get("code") in ENDPOINT_ERROR_CODES
+        or "rate limit" in message
+        or "too many requests" in message
+    )
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """
+    spread requests over several endpoints of one chain.
+
+    Endpoints are picked at random weighted by 1 / score, so faster and healthier
+    endpoints get more traffic. After failure_threshold consecutive failures an
+    endpoint is ejected for cooldown seconds. Failed idempotent requests are retried
+    on another endpoint, up to max_retries times.
+    """
+
+    def __init__(
+        self,
+        providers,
+        max_retries=2,
+        failure_threshold=3,
+        cooldown=30,
+    ):
+        super().__init__()
+        if not providers:
+            raise ValueError("at least one provider is required")
+        self.endpoints = [
+            (
+                p
+                if isinstance(p, Endpoint)
+                else Endpoint(p, 0.2, failure_threshold, cooldown)
+            )
+            for p in providers
+        ]
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __str__(self):
+        return f"RPC pool {', '.join(str(e) for e in self.endpoints)}"
+
+    def choose(self, exclude=()) -> Endpoint:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                e for e in self.endpoints if e not in exclude and e.is_available(now)
+            ]
+            if not candidates:
+                # everything is ejected, fall back to the endpoint recovering first
+                remaining = [e for e in self.endpoints if e not in exclude]
+                candidates = [
+                    min(remaining or self.endpoints, key=lambda e: e.open_until)
+                ]
+            weights = [1 / max(e.score, 1e-6) for e in candidates]
+            return random.choices(candidates, weights)[0]
+
+    def last_call(self):
+        """(endpoint uri, retries) of the last call made by this thread"""
+        return getattr(self._local, "endpoint", None), getattr(
+            self._local, "retries", 0
+        )
+
+    def make_request(self, method, params):
+        return self._call(method, lambda p: p.make_request(method, params))
+
+    def make_batch_request(self, requests, batch_size=None):
+        return self._call(
+            "batch",
+            lambda p: make_batch_request(p, requests, batch_size),
+            retry=all(m not in NON_IDEMPOTENT_METHODS for m, _ in requests),
+        )
+
+    def _call(self, method, call, retry=None):
+        if retry is None:
+            retry = method not in NON_IDEMPOTENT_METHODS
+        attempts = 1 + (self.max_retries if retry else 0)
+        tried = []
+        for i in range(attempts):
+            endpoint = self.choose(exclude=tried)
+            tried.append(endpoint)
+            self._local.endpoint = endpoint.provider.endpoint_uri
+            self._local.retries = i
+            start = time.monotonic()
+            try:
+                response = call(endpoint.provider)
+            except Exception as e:
+                with self._lock:
+                    endpoint.record_failure()
+                logger.warning(f"{method} failed on {endpoint}: {e}, the {i+1} time")
+                if i + 1 == attempts:
+                    raise
+                continue
+
+            failed = (
+                any(is_endpoint_error(r) for r in response)
+                if isinstance(response, list)
+                else is_endpoint_error(response)
+            )
+            with self._lock:
+                if failed:
+                    endpoint.record_failure()
+                else:
+                    endpoint.record_success(time.monotonic() - start)
+            if not failed or i + 1 == attempts:
+                return response
+            logger.warning(f"{method} rejected by {endpoint}, the {i+1} time")
+
+
+class HedgedHTTPProvider(JSONBaseProvider):
+    """
+    cut tail latency: a read-only request goes to the first provider, and when it
+    hasn't answered within the percentile latency of its method (or answered null
+    or an endpoint error) a duplicate goes to the next backup provider. The first
+    valid answer wins, the other request is cancelled if it wasn't sent yet and
+    its answer dropped otherwise.
+
+    Hedges are paid from a budget, every request earns budget hedges (at most
+    burst are saved up), so duplicates stay around budget * requests.
+
+    :param providers: primary first, then the backups, used round robin
+    :param percentile: of the primary's recent latencies per method
+    :param initial_delay: hedge delay until window / 10 latencies are known
+    """
+
+    def __init__(
+        self,
+        providers,
+        percentile=0.95,
+        min_delay=0.02,
+        max_delay=2,
+        initial_delay=0.25,
+        budget=0.1,
+        burst=10,
+        window=200,
+        max_workers=64,
+    ):
+        super().__init__()
+        if len(providers) < 2:
+            raise ValueError("hedging needs a primary and at least one backup")
+        self.providers = list(providers)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.budget = budget
+        self.burst = burst
+        self.window = window
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._tokens = burst
+        self._backup = 0
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __str__(self):
+        return f"RPC hedged {', '.join(str(p.endpoint_uri) for p in self.providers)}"
+
+    def last_call(self):
+        """(endpoint uri, retries) of the last answer this thread got"""
+        return getattr(self._local, "endpoint", None), 0
+
+    def hedge_delay(self, method) -> float:
+        with self._lock:
+            # executor threads append to the deque while requests read it
+            latencies = list(self._latencies[method])
+        if len(latencies) < max(self.window // 10, 1):
+            return self.initial_delay
+        latencies.sort()
+        delay = latencies[int(self.percentile * (len(latencies) - 1))]
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def make_request(self, method, params):
+        call = lambda p: p.make_request(method, params)
+        if method in NON_IDEMPOTENT_METHODS:
+            self._local.endpoint = self.providers[0].endpoint_uri
+            return call(self.providers[0])
+        return self._hedged(method, call)
+
+    def make_batch_request(self, requests, batch_size=None):
+        call = lambda p: make_batch_request(p, requests, batch_size)
+        if any(m in NON_IDEMPOTENT_METHODS for m, _ in requests):
+            self._local.endpoint = self.providers[0].endpoint_uri
+            return call(self.providers[0])
+        return self._hedged("batch", call)
+
+    def _take_token(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+
+    def _next_backup(self):
+        with self._lock:
+            self._backup = self._backup % (len(self.providers) - 1) + 1
+            return self.providers[self._backup]
+
+    @staticmethod
+    def _is_valid(response) -> bool:
+        if isinstance(response, list):
+            return not any(is_endpoint_error(r) for r in response)
+        return not is_endpoint_error(response) and response.get("result") is not None
+
+    def _hedged(self, method, call):
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+        def send(provider):
+            start = time.monotonic()
+            response = call(provider)
+            return response, time.monotonic() - start
+
+        def record(future):
+            # the primary's latency, won or not, is what the hedge delay is taken from
+            if not future.cancelled() and future.exception() is None:
+                with self._lock:
+                    self._latencies[method].append(future.result()[1])
+
+        primary = self.providers[0]
+        future = self._executor.submit(send, primary)
+        future.add_done_callback(record)
+        providers = {future: primary}
+        pending = {future}
+        may_hedge = True
+        fallback = error = None
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=self.hedge_delay(method) if may_hedge else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                try:
+                    response, _ = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if not self._is_valid(response):
+                    fallback = response, providers[future]
+                    continue
+                for other in pending:
+                    other.cancel()
+                provider = providers[future]
+                if provider is not primary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                self._local.endpoint = provider.endpoint_uri
+                return response
+            if may_hedge:
+                # primary is slow, failed or answered null
+                may_hedge = False
+                if self._take_token():
+                    backup = self._next_backup()
+                    future = self._executor.submit(send, backup)
+                    providers[future] = backup
+                    pending.add(future)
+
+        if fallback is not None:
+            response, provider = fallback
+            self._local.endpoint = provider.endpoint_uri
+            return response
+        raise error
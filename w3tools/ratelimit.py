@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from loguru import logger
+
+# compute units per method, roughly what providers bill (alchemy's table),
+# pass as method_costs to make_w3 to budget in compute units instead of requests
+METHOD_COSTS = {
+    "eth_chainId": 0,
+    "net_version": 0,
+    "eth_blockNumber": 10,
+    "eth_getBalance": 19,
+    "eth_getCode": 26,
+    "eth_getStorageAt": 17,
+    "eth_getTransactionCount": 26,
+    "eth_call": 26,
+    "eth_estimateGas": 87,
+    "eth_gasPrice": 19,
+    "eth_getBlockByNumber": 16,
+    "eth_getBlockByHash": 16,
+    "eth_getTransactionByHash": 17,
+    "eth_getTransactionReceipt": 15,
+    "eth_getBlockReceipts": 500,
+    "eth_getLogs": 75,
+    "eth_sendRawTransaction": 250,
+    "debug_traceTransaction": 309,
+    "debug_traceCall": 309,
+    "debug_traceBlockByNumber": 500,
+}
+DEFAULT_COST = 20
+
+
+class TokenBucket:
+    """
+    token bucket refilled at rate tokens per second, holding at most burst tokens.
+
+    acquire reserves the tokens right away and sleeps exactly until they are paid
+    back, so callers are served in order and the rate is never exceeded.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1) -> float:
+        """take cost tokens, return seconds to wait before they are available"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= cost
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self, cost=1) -> float:
+        wait = self.reserve(cost)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, cost=1) -> float:
+        wait = self.reserve(cost)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _normalize_uri(uri) -> str:
+    parts = urlsplit(str(uri))
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path.rstrip("/"),
+            parts.query,
+            "",
+        )
+    )
+
+
+def endpoint_key(provider) -> str:
+    """
+    bucket key of a provider or an endpoint url, the normalized endpoint url(s),
+    so clients of one endpoint share a bucket whatever provider wraps it
+    """
+    while getattr(provider, "provider", None) is not None:  # CassetteProvider
+        provider = provider.provider
+    if isinstance(provider, str):
+        uris = [provider]
+    elif hasattr(provider, "endpoints"):  # PooledHTTPProvider
+        uris = [endpoint.provider.endpoint_uri for endpoint in provider.endpoints]
+    elif hasattr(provider, "providers"):  # HedgedHTTPProvider
+        uris = [p.endpoint_uri for p in provider.providers]
+    else:
+        uris = [getattr(provider, "endpoint_uri", None) or str(provider)]
+    return ",".join(_normalize_uri(uri) for uri in uris)
+
+
+def get_bucket(key, rate, burst=None) -> TokenBucket:
+    """
+    buckets are shared by key, so all clients of one endpoint share its budget,
+    the first client's rate and burst win
+
+    :param key: endpoint_key of the endpoint
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate, burst)
+        elif bucket.rate != rate or bucket.capacity != (burst or rate):
+            # the key holds the endpoint url and with it the api key, keep it out
+            logger.warning(
+                f"rate limit {rate}/s burst {burst or rate} ignored, the endpoint is "
+                f"already limited to {bucket.rate}/s burst {bucket.capacity}"
+            )
+        return bucket
+
+
+class RateLimiter:
+    """
+    charges requests against a bucket by method cost
+
+    :param method_costs: {method: cost}, every request costs 1 when not given
+    :param metrics: Metrics to record waits to
+    """
+
+    def __init__(self, bucket: TokenBucket, method_costs=None, metrics=None):
+        self.bucket = bucket
+        self.method_costs = method_costs
+        self.metrics = metrics
+
+    def cost(self, *methods) -> float:
+        if self.method_costs is None:
+            return len(methods)
+        return sum(self.method_costs.get(m, DEFAULT_COST) for m in methods)
+
+    def acquire(self, *methods) -> float:
+        """block until methods fit in the budget, return seconds waited"""
+        wait = self.bucket.acquire(self.cost(*methods))
+        self._record(methods, wait)
+        return wait
+
+    async def acquire_async(self, *methods) -> float:
+        wait = await self.bucket.acquire_async(self.cost(*methods))
+        self._record(methods, wait)
+        return wait
+
+    def _record(self, methods, wait):
+        if self.metrics is not None:
+            method = methods[0] if len(methods) == 1 else "batch"
+            self.metrics.record_rate_limit_wait(method, wait)
+
+
+def construct_rate_limit_middleware(limiter: RateLimiter):
+    def rate_limit_middleware(make_request, w3):
+        def middleware(method, params):
+            limiter.acquire(method)
+            return make_request(method, params)
+
+        return middleware
+
+    return rate_limit_middleware
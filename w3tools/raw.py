@@ -0,0 +1,186 @@
+import json
+from collections.abc import Mapping
+from functools import lru_cache
+
+from hexbytes import HexBytes
+from web3 import Web3
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:  # pragma: no cover
+    loads = json.loads
+
+
+INT_FIELDS = frozenset(
+    [
+        "baseFeePerGas",
+        "blobGasUsed",
+        "blockNumber",
+        "chainId",
+        "cumulativeGasUsed",
+        "difficulty",
+        "effectiveGasPrice",
+        "excessBlobGas",
+        "gas",
+        "gasLimit",
+        "gasPrice",
+        "gasUsed",
+        "logIndex",
+        "maxFeePerBlobGas",
+        "maxFeePerGas",
+        "maxPriorityFeePerGas",
+        "nonce",
+        "number",
+        "size",
+        "status",
+        "timestamp",
+        "totalDifficulty",
+        "transactionIndex",
+        "type",
+        "v",
+        "value",
+        "yParity",
+    ]
+)
+BYTES_FIELDS = frozenset(
+    [
+        "blockHash",
+        "data",
+        "extraData",
+        "hash",
+        "input",
+        "logsBloom",
+        "mixHash",
+        "output",
+        "parentBeaconBlockRoot",
+        "parentHash",
+        "r",
+        "receiptsRoot",
+        "root",
+        "s",
+        "sha3Uncles",
+        "stateRoot",
+        "transactionHash",
+        "transactionsRoot",
+        "withdrawalsRoot",
+    ]
+)
+ADDRESS_FIELDS = frozenset(["address", "contractAddress", "from", "miner", "to"])
+# lists of hashes, or of objects for transactions and logs
+LIST_FIELDS = frozenset(["logs", "topics", "transactions", "uncles"])
+
+_checksum = lru_cache(maxsize=100000)(Web3.to_checksum_address)
+
+
+def _convert(key, value):
+    if value is None:
+        return None
+    if key in INT_FIELDS:
+        return int(value, 16) if isinstance(value, str) else value
+    if key in BYTES_FIELDS:
+        return HexBytes(value)
+    if key in ADDRESS_FIELDS:
+        return _checksum(value)
+    if key in LIST_FIELDS:
+        return [view(v) for v in value]
+    return value
+
+
+def view(value):
+    """wrap parsed json, objects become RawView and hex strings HexBytes"""
+    if isinstance(value, dict):
+        return RawView(value)
+    if isinstance(value, list):
+        return [view(v) for v in value]
+    if isinstance(value, str) and value.startswith("0x"):
+        return HexBytes(value)
+    return value
+
+
+class RawView(Mapping):
+    """
+    read only view over a json-rpc object as parsed from the wire.
+
+    fields are converted the way web3's result formatters would (quantities to
+    int, hashes and data to HexBytes, addresses checksummed) but only when read,
+    each field once. Unread fields cost nothing, e.g. logsBloom of every receipt.
+    The raw dict is what gets pickled.
+    """
+
+    __slots__ = ("raw", "_values")
+
+    def __init__(self, raw: dict):
+        self.raw = raw
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = _convert(key, self.raw[key])
+            return value
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def __repr__(self):
+        return f"RawView({self.raw!r})"
+
+    def __reduce__(self):
+        return RawView, (self.raw,)
+
+
+def decode_rpc_response(raw_response: bytes) -> dict:
+    return loads(raw_response)
+
+
+class SizedResponse(dict):
+    """json-rpc response which knows the byte size of the http body it came in"""
+
+    __slots__ = ("size",)
+
+    def __init__(self, response, size):
+        super().__init__(response)
+        self.size = size
+
+
+def sized_decoder(decode):
+    """wrap a provider's decode_rpc_response to return SizedResponses"""
+
+    def decode_sized(raw_response):
+        return SizedResponse(decode(raw_response), len(raw_response))
+
+    return decode_sized
+
+
+def raw_request(w3, method, params, make_request=None):
+    """
+    send a request straight to the provider, skipping the middlewares and result
+    formatters. The rate limiter of w3 is still charged.
+
+    :param make_request: sends the request, defaults to the provider's
+    :return: RawView for objects, list of RawView for lists of objects
+    """
+    limiter = getattr(w3, "rate_limiter", None)
+    if limiter is not None:
+        limiter.acquire(method)
+    if make_request is None:
+        make_request = w3.provider.make_request
+    response = make_request(method, params)
+    if "error" in response:
+        raise ValueError(response["error"])
+    return view(response["result"])
@@ -0,0 +1,179 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+from w3tools.cassette import CassetteMiss
+from w3tools.metrics import endpoint_label
+
+# seconds a call may spend on all its attempts, heavy methods get longer
+METHOD_DEADLINES = {
+    "debug_traceBlockByNumber": 60,
+    "debug_traceTransaction": 30,
+    "debug_traceCall": 30,
+    "eth_getBlockReceipts": 30,
+    "eth_getLogs": 30,
+}
+DEFAULT_DEADLINE = 15
+
+# json-rpc error codes which retrying can't fix
+FATAL_ERROR_CODES = {
+    -32600,  # invalid request
+    -32601,  # method not found
+    -32602,  # invalid params
+    3,  # execution reverted
+}
+FATAL_ERROR_MESSAGES = (
+    "method not found",
+    "not supported",
+    "does not exist/is not available",
+    "invalid argument",
+    "execution reverted",
+    "missing trie node",
+    "historical state",
+    "pruned",
+)
+
+
+class MissingResultError(Exception):
+    """
+    the node answered null, e.g. for the receipts or traces of a block it is still
+    indexing, worth another try
+    """
+
+
+class RetryError(Exception):
+    """every attempt failed, or one failed with a fatal error"""
+
+    def __init__(self, method, attempts, error):
+        super().__init__(f"{method} failed after {attempts} attempts: {error}")
+        self.method = method
+        self.attempts = attempts
+        self.error = error
+
+
+def _rpc_error(e: Exception):
+    """the json-rpc error dict web3 and raw_request raise ValueErrors with"""
+    if e.args and isinstance(e.args[0], dict):
+        return e.args[0]
+    return None
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    rate limits, timeouts, connection errors, 5xx responses and missing results
+    are retryable, bad requests, state the node doesn't have and requests a
+    replayed cassette doesn't have are fatal. Errors nothing is known about are
+    retried.
+    """
+    if isinstance(e, CassetteMiss):
+        return False
+    if isinstance(e, (MissingResultError, TimeoutError, OSError)):
+        # requests' exceptions are OSErrors
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        return status is None or status == 429 or status >= 500
+    status = getattr(e, "status", None)  # aiohttp.ClientResponseError
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    error = _rpc_error(e)
+    if error is not None:
+        if error.get("code") in FATAL_ERROR_CODES:
+            return False
+        message = str(error.get("message", "")).lower()
+        return not any(m in message for m in FATAL_ERROR_MESSAGES)
+    return True
+
+
+@dataclass
+class RetryPolicy:
+    """
+    exponential backoff with full jitter: attempt n waits a random time up to
+    base_delay * multiplier ** n, capped at max_delay. A call stops after
+    max_attempts, on a fatal error, or when the next wait would end past its
+    method's deadline.
+
+    :param deadlines: {method: seconds} over METHOD_DEADLINES
+    :param classify: error -> retryable, is_retryable by default
+    """
+
+    max_attempts: int = 5
+    base_delay: float = 0.1
+    multiplier: float = 2
+    max_delay: float = 5
+    deadline: float = DEFAULT_DEADLINE
+    deadlines: dict = field(default_factory=dict)
+    classify: object = is_retryable
+
+    def deadline_for(self, method) -> float:
+        if method in self.deadlines:
+            return self.deadlines[method]
+        return METHOD_DEADLINES.get(method, self.deadline)
+
+    def delay(self, attempt) -> float:
+        cap = min(self.max_delay, self.base_delay * self.multiplier**attempt)
+        return random.uniform(0, cap)
+
+    def _next_delay(self, method, attempt, attempts, start, error):
+        """seconds to wait before the next attempt, raise RetryError to give up"""
+        if attempt + 1 >= attempts or not self.classify(error):
+            raise RetryError(method, attempt + 1, error) from error
+        delay = self.delay(attempt)
+        if time.monotonic() - start + delay > self.deadline_for(method):
+            raise RetryError(method, attempt + 1, error) from error
+        logger.warning(
+            f"{method} failed: {error}, retry in {delay:.2f}s, the {attempt + 1} time"
+        )
+        return delay
+
+    def call(self, method, fn, *args, attempts=None, on_retry=None, **kwargs):
+        """
+        fn(*args, **kwargs) with retries
+
+        :param attempts: overrides max_attempts
+        :param on_retry: on_retry(attempt, error) before every retry
+        """
+        attempts = attempts or self.max_attempts
+        start = time.monotonic()
+        for attempt in range(attempts):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(method, attempt, attempts, start, e)
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                time.sleep(delay)
+
+    async def acall(self, method, fn, *args, attempts=None, on_retry=None, **kwargs):
+        """call for coroutine functions"""
+        attempts = attempts or self.max_attempts
+        start = time.monotonic()
+        for attempt in range(attempts):
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(method, attempt, attempts, start, e)
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                await asyncio.sleep(delay)
+
+
+default_policy = RetryPolicy()
+
+
+def call_with_retry(w3, method, fn, *args, attempts=None, **kwargs):
+    """
+    RetryPolicy.call with the policy make_w3 set on w3, retries are recorded to
+    w3.metrics
+    """
+    policy = getattr(w3, "retry_policy", None) or default_policy
+    metrics = getattr(w3, "metrics", None)
+    on_retry = None
+    if metrics is not None:
+        on_retry = lambda attempt, e: metrics.record_retry(
+            method, endpoint_label(w3.provider)
+        )
+    return policy.call(
+        method, fn, *args, attempts=attempts, on_retry=on_retry, **kwargs
+    )
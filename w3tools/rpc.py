@@ -70,3 +70,22 @@ WS_PROVIDERS = {
         RPC_PROVIDER.ALCHEMY: "wss://eth-sepolia.g.alchemy.com/v2/{}",
     },
 }
+
+
+def pool_endpoints(chain: ChainId, api_keys: dict = None) -> list:
+    """
+    remote http endpoints of chain, keyed ones only for providers in api_keys
+
+    :param api_keys: {RPC_PROVIDER or name: api_key}
+    """
+    api_keys = {RPC_PROVIDER(k): v for k, v in (api_keys or {}).items()}
+    endpoints = []
+    for provider, endpoint in HTTP_PROVIDERS[chain].items():
+        if provider in (RPC_PROVIDER.LOCAL, RPC_PROVIDER.ANVIL):
+            continue
+        if "{}" in endpoint:
+            if provider not in api_keys:
+                continue
+            endpoint = endpoint.format(api_keys[provider])
+        endpoints.append(endpoint)
+    return endpoints
@@ -0,0 +1,152 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import List
+
+from web3 import Web3
+
+from w3tools.tx import TX
+
+UNISWAP_V2_SWAP = Web3.keccak(
+    text="Swap(address,uint256,uint256,uint256,uint256,address)"
+)
+UNISWAP_V3_SWAP = Web3.keccak(
+    text="Swap(address,address,int256,int256,uint160,uint128,int24)"
+)
+PANCAKE_V3_SWAP = Web3.keccak(
+    text="Swap(address,address,int256,int256,uint160,uint128,int24,uint128,uint128)"
+)
+
+# a backrun must sell what the frontrun bought, give or take this share
+# (transfer fees, dust left in the bot)
+UNWIND_TOLERANCE = 0.2
+
+
+@dataclass
+class Swap:
+    tx_index: int
+    pool: str
+    # True when token0 goes into the pool
+    zero_for_one: bool
+    # (tx sender, tx to)
+    actor: tuple
+    amount_in: int
+    amount_out: int
+
+
+@dataclass
+class Sandwich:
+    pool: str
+    attacker: str
+    frontrun: str
+    backrun: str
+    victims: List[str] = field(default_factory=list)
+
+
+def _to_bytes(value) -> bytes:
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+    return bytes(value)
+
+
+def _int(data: bytes, word: int, signed=False) -> int:
+    return int.from_bytes(data[word * 32 : word * 32 + 32], "big", signed=signed)
+
+
+def parse_swap(log):
+    """
+    return (pool, zero_for_one, amount_in, amount_out) for uniswap v2 / v3 style
+    swap logs, else None
+    """
+    topics = log["topics"]
+    if not topics:
+        return None
+    topic0 = _to_bytes(topics[0])
+    if topic0 == UNISWAP_V2_SWAP:
+        data = _to_bytes(log["data"])
+        # amount0In, amount1In, amount0Out, amount1Out
+        zero_for_one = _int(data, 0) > 0
+        if zero_for_one:
+            amount_in, amount_out = _int(data, 0), _int(data, 3)
+        else:
+            amount_in, amount_out = _int(data, 1), _int(data, 2)
+    elif topic0 == UNISWAP_V3_SWAP or topic0 == PANCAKE_V3_SWAP:
+        data = _to_bytes(log["data"])
+        # amount0 is positive when token0 is paid into the pool
+        amount0, amount1 = _int(data, 0, signed=True), _int(data, 1, signed=True)
+        zero_for_one = amount0 > 0
+        if zero_for_one:
+            amount_in, amount_out = amount0, -amount1
+        else:
+            amount_in, amount_out = amount1, -amount0
+    else:
+        return None
+    return Web3.to_checksum_address(log["address"]), zero_for_one, amount_in, amount_out
+
+
+def unwinds(front: Swap, back: Swap) -> bool:
+    """back sells roughly the amount front bought"""
+    return abs(back.amount_in - front.amount_out) <= UNWIND_TOLERANCE * max(
+        front.amount_out, 1
+    )
+
+
+def find_sandwiches(txs: List[TX]) -> List[Sandwich]:
+    """
+    find sandwiches in block ordered txs in one pass.
+
+    Swaps are indexed by pool as they are seen. A swap by some actor (the tx
+    sender and `to`, usually a bot contract behind its own eoa, so users of a
+    shared router stay apart) opens a possible frontrun on its pool and
+    direction. A later swap by the same actor in the opposite direction on the
+    same pool, selling roughly what the frontrun bought, closes it. If swaps by
+    other actors in the frontrun direction happened in between, those are the
+    victims. Every frontrun is closed at most once and only the swaps in between
+    on that pool are looked at, so the cost stays roughly linear in the number
+    of swaps.
+    """
+    pool_swaps = defaultdict(list)  # pool -> [Swap]
+    open_fronts = {}  # (pool, actor, zero_for_one) -> position in pool_swaps
+    sandwiches = []
+
+    for tx_index, tx in enumerate(txs):
+        if not tx.to or tx.status != 1:
+            continue
+        actor = (tx.sender, tx.to)
+        for log in tx.logs:
+            parsed = parse_swap(log)
+            if parsed is None:
+                continue
+            pool, zero_for_one, amount_in, amount_out = parsed
+            swaps = pool_swaps[pool]
+            swap = Swap(tx_index, pool, zero_for_one, actor, amount_in, amount_out)
+
+            front_position = open_fronts.get((pool, actor, not zero_for_one))
+            if front_position is not None and unwinds(swaps[front_position], swap):
+                del open_fronts[(pool, actor, not zero_for_one)]
+                front = swaps[front_position]
+                victims = []
+                for other in swaps[front_position + 1 :]:
+                    if (
+                        other.actor != actor
+                        and other.zero_for_one == front.zero_for_one
+                        and other.tx_index != tx_index
+                        and (not victims or victims[-1] != other.tx_index)
+                    ):
+                        victims.append(other.tx_index)
+                if victims and front.tx_index != tx_index:
+                    sandwiches.append(
+                        Sandwich(
+                            pool=pool,
+                            attacker=tx.to,
+                            frontrun=txs[front.tx_index].txhash,
+                            backrun=tx.txhash,
+                            victims=[txs[i].txhash for i in victims],
+                        )
+                    )
+                    swaps.append(swap)
+                    continue
+
+            open_fronts[(pool, actor, zero_for_one)] = len(swaps)
+            swaps.append(swap)
+
+    return sandwiches
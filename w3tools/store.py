@@ -0,0 +1,94 @@
+import pickle
+import sqlite3
+import threading
+import zlib
+
+from hexbytes import HexBytes
+
+from w3tools.chain import ChainId
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    chain INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER,
+    hash TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (chain, kind, hash)
+);
+CREATE INDEX IF NOT EXISTS payloads_number ON payloads (chain, kind, number);
+"""
+
+
+def _hex(value):
+    if isinstance(value, (bytes, HexBytes)):
+        return "0x" + bytes(value).hex()
+    return value.lower()
+
+
+class Store:
+    """
+    persistent sqlite store for blocks, receipts and traces.
+
+    payloads are zlib compressed pickles, keyed by chain, kind and hash (block hash
+    for block level kinds, txhash for tx level kinds) and indexed by block number.
+    The database runs in WAL mode, so any number of threads or processes can read
+    while one of them writes.
+
+    kinds: block, block_light, receipts, traces, receipt, trace
+    """
+
+    def __init__(self, path="w3tools.db"):
+        self.path = path
+        self._local = threading.local()
+        self._conn.executescript(SCHEMA)
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, chain: ChainId, kind: str, number: int = None, hash=None):
+        """get payload by hash, or the latest stored one by block number"""
+        if hash is not None:
+            row = self._conn.execute(
+                "SELECT payload FROM payloads WHERE chain=? AND kind=? AND hash=?",
+                (int(chain), kind, _hex(hash)),
+            ).fetchone()
+        elif number is not None:
+            row = self._conn.execute(
+                "SELECT payload FROM payloads WHERE chain=? AND kind=? AND number=?"
+                " ORDER BY rowid DESC LIMIT 1",
+                (int(chain), kind, number),
+            ).fetchone()
+        else:
+            raise ValueError("number or hash must be provided")
+        if row is None:
+            return None
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, chain: ChainId, kind: str, number: int, hash, payload):
+        data = zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO payloads (chain, kind, number, hash, payload)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (int(chain), kind, number, _hex(hash), data),
+        )
+
+    def delete(self, chain: ChainId, number: int):
+        """delete everything stored at and above block number"""
+        self._conn.execute(
+            "DELETE FROM payloads WHERE chain=? AND number>=?", (int(chain), number)
+        )
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -1,15 +1,186 @@
-import time
+from collections import Counter
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from typing import Iterator, List
 
 from eth_typing import ChecksumAddress
+from hexbytes import HexBytes
 from loguru import logger
+from web3.exceptions import TransactionNotFound
 from web3.types import TxData, TxReceipt
 
+from w3tools.cache import ReorgAwareCache, heads
 from w3tools.chain import ChainId
+from w3tools.metrics import metrics
+from w3tools.retry import MissingResultError, RetryError, call_with_retry
+from w3tools.store import Store
 from w3tools.w3 import make_w3
 
 DUMMY_TXHASH = "0x" + "0" * 64
 
+CALL_QUANTITY_FIELDS = (
+    "value",
+    "gas",
+    "gasPrice",
+    "maxFeePerGas",
+    "maxPriorityFeePerGas",
+    "nonce",
+)
+
+
+def block_param(block_number) -> str:
+    """json-rpc block param from a number or a tag"""
+    if isinstance(block_number, int):
+        return hex(block_number)
+    return block_number
+
+
+def call_object(call: dict) -> dict:
+    """
+    json-rpc call object from a call dict, quantities may be ints, data bytes
+    ("input" is taken for "data"), None values are left out
+    """
+    payload = {}
+    for key, value in call.items():
+        if value is None:
+            continue
+        if key in ("data", "input"):
+            payload["data"] = (
+                "0x" + bytes(value).hex()
+                if isinstance(value, (bytes, bytearray))
+                else value
+            )
+        elif key in CALL_QUANTITY_FIELDS:
+            payload[key] = value if isinstance(value, str) else hex(int(value))
+        else:
+            payload[key] = value
+    return payload
+
+
+def simulated_txdata(payload: dict) -> dict:
+    """txdata of a simulated TX, shaped like the formatted txdata of a pending tx"""
+    txdata = {"from": payload.get("from"), "to": payload.get("to")}
+    for key in CALL_QUANTITY_FIELDS:
+        if key in payload:
+            txdata[key] = int(payload[key], 16)
+    txdata.setdefault("value", 0)
+    txdata["input"] = txdata["data"] = HexBytes(payload.get("data", "0x"))
+    return txdata
+
+
+def trace_call_config(state_overrides=None) -> dict:
+    config = {"tracer": "callTracer", "tracerConfig": {"withLog": True}}
+    if state_overrides:
+        config["stateOverrides"] = state_overrides
+    return config
+
+
+class CallFrame(Mapping):
+    """
+    read-only view of a callTracer frame, value is decoded to int on access.
+    depth is 1 for calls made by the tx itself.
+    """
+
+    __slots__ = ("frame", "depth")
+
+    def __init__(self, frame, depth):
+        self.frame = frame
+        self.depth = depth
+
+    def __getitem__(self, key):
+        if key == "value":
+            value = self.frame.get("value", "0x0")
+            return int(value, 16) if isinstance(value, str) else value
+        return self.frame[key]
+
+    def __iter__(self):
+        yield from self.frame
+        if "value" not in self.frame:
+            yield "value"
+
+    def __len__(self):
+        return len(self.frame) + ("value" not in self.frame)
+
+    def __repr__(self):
+        return f"CallFrame({dict(self)}, depth={self.depth})"
+
+
+def iter_calls(root) -> Iterator[CallFrame]:
+    """depth first walk over the calls below root, iterative so deep traces are fine"""
+    stack = [(call, 1) for call in reversed(root.get("calls") or [])]
+    while stack:
+        frame, depth = stack.pop()
+        yield CallFrame(frame, depth)
+        children = frame.get("calls")
+        if children:
+            stack.extend((call, depth + 1) for call in reversed(children))
+
+
+@dataclass
+class TraceSummary:
+    """everything TX needs from a trace, filled in one walk"""
+
+    internal_txs: List[CallFrame] = field(default_factory=list)
+    logs: list = field(default_factory=list)
+    create_calls: List[CallFrame] = field(default_factory=list)
+    max_call_depth: int = 0
+    call_type_counts: Counter = field(default_factory=Counter)
+
+    def add(self, call: CallFrame):
+        self.internal_txs.append(call)
+        frame = call.frame
+        call_type = frame.get("type", "").upper()
+        self.call_type_counts[call_type] += 1
+        if call_type in ("CREATE", "CREATE2"):
+            self.create_calls.append(call)
+        if call.depth > self.max_call_depth:
+            self.max_call_depth = call.depth
+        logs = frame.get("logs")
+        if logs:
+            self.logs.extend(logs)
+
+
+@dataclass(frozen=True)
+class BlockHeader:
+    number: int
+    hash: str
+    timestamp: int
+    miner: ChecksumAddress
+    # None before london / on chains without eip-1559
+    base_fee: int = None
+    parent_hash: str = None
+    gas_limit: int = None
+
+    @classmethod
+    def from_block(cls, block) -> "BlockHeader":
+        return cls(
+            number=block["number"],
+            hash=block["hash"],
+            timestamp=block["timestamp"],
+            miner=block["miner"],
+            base_fee=block.get("baseFeePerGas"),
+            parent_hash=block["parentHash"],
+            gas_limit=block.get("gasLimit"),
+        )
+
+
+# shared by standalone TXs, so txs of one block fetch its header once
+cache_header = ReorgAwareCache(maxsize=10000)
+
+
+def get_header(chain: ChainId, number: int, w3) -> BlockHeader:
+    key = (chain, number)
+    header = cache_header.get(key)
+    metrics.record_cache("header", header is not None)
+    if header is None:
+        block = w3.eth.get_block(number)
+        header = BlockHeader.from_block(block)
+        cache_header.on_block(chain, number, block["hash"], block["parentHash"])
+        cache_header.set(chain, number, key, header)
+    return header
+
 
 class TX:
     def __init__(
@@ -20,16 +191,20 @@ class TX:
         txdata: TxData = None,
         receipt: TxReceipt = None,
         trace=None,
+        store: Store = None,
+        header: BlockHeader = None,
     ):
+        """
+        :param header: header of the including block, Block passes its own
+        """
         self._chain = chain
         if isinstance(txhash, bytes):
             self._txhash = txhash.hex()
         else:
             self._txhash = txhash
 
-        if w3 is None:
-            w3 = make_w3(chain)
-        self.w3 = w3
+        # made on first use, txs built from payloads may never need it
+        self._w3 = w3
 
         self._txdata = txdata
 
@@ -37,6 +212,31 @@ class TX:
 
         self._trace = trace
 
+        self.store = store
+
+        if header is not None:
+            self.header = header
+
+        # payloads which couldn't be fetched, "trace" when it is an empty stand-in
+        self.degraded = set()
+
+    @property
+    def w3(self):
+        if self._w3 is None:
+            self._w3 = make_w3(self.chain)
+        return self._w3
+
+    @property
+    def _raw(self) -> bool:
+        return getattr(self.w3, "raw", False)
+
+    def _is_finalized(self, number) -> bool:
+        """only finalized payloads go to the store"""
+        if self.store is None:
+            return False
+        heads.refresh(self.chain, self.w3)
+        return heads.is_finalized(self.chain, number)
+
     def __hash__(self):
         return int(self.txhash, 16)
 
@@ -52,12 +252,31 @@ class TX:
     def txhash(self) -> str:
         return self._txhash
 
+    def _fetch(self, method, get):
+        """one attempt at a tx lookup, raw or through web3's get"""
+        if self._raw:
+            result = self.w3.raw_request(method, [self.txhash])
+        else:
+            try:
+                result = get(self.txhash)
+            except TransactionNotFound:
+                result = None
+        if result is None:
+            raise MissingResultError(f"{method} found nothing for {self.txhash}")
+        return result
+
     ## txdata
     @property
     def txdata(self):
         try:
             if self._txdata is None:
-                self._txdata = self.w3.eth.get_transaction(self.txhash)
+                self._txdata = call_with_retry(
+                    self.w3,
+                    "eth_getTransactionByHash",
+                    self._fetch,
+                    "eth_getTransactionByHash",
+                    self.w3.eth.get_transaction,
+                )
         except Exception as e:
             logger.error(f"get txdata failed: {e}, txhash: {self.txhash}")
         return self._txdata
@@ -69,7 +288,26 @@ class TX:
             if self.is_pending:
                 self._receipt = self._logs_from_trace()
             else:
-                self._receipt = self.w3.eth.get_transaction_receipt(self.txhash)
+                if self.store is not None:
+                    self._receipt = self.store.get(
+                        self.chain, "receipt", hash=self.txhash
+                    )
+                if self._receipt is None:
+                    self._receipt = call_with_retry(
+                        self.w3,
+                        "eth_getTransactionReceipt",
+                        self._fetch,
+                        "eth_getTransactionReceipt",
+                        self.w3.eth.get_transaction_receipt,
+                    )
+                    if self._is_finalized(self._receipt["blockNumber"]):
+                        self.store.put(
+                            self.chain,
+                            "receipt",
+                            self._receipt["blockNumber"],
+                            self.txhash,
+                            self._receipt,
+                        )
         return self._receipt
 
     ## trace
@@ -77,23 +315,42 @@ class TX:
     def trace(self):
         if self._trace:
             return self._trace
-        for i in range(1):
-            try:
-                res = self.w3.provider.make_request(
-                    "debug_traceTransaction",
-                    [
-                        self.txhash,
-                        {"tracer": "callTracer", "tracerConfig": {"withLog": True}},
-                    ],
-                )
-                assert res["result"] != None
-                return res
-            except Exception as e:
-                logger.error(
-                    f"get calls from debug_traceTransaction failed: {e}, the {i+1} time, res: {res}"
-                )
-                time.sleep(0.5)
-        return {"result": {"calls": []}}
+        if self.store is not None:
+            trace = self.store.get(self.chain, "trace", hash=self.txhash)
+            if trace is not None:
+                return trace
+
+        def fetch():
+            res = self.w3.provider.make_request(
+                "debug_traceTransaction",
+                [
+                    self.txhash,
+                    {"tracer": "callTracer", "tracerConfig": {"withLog": True}},
+                ],
+            )
+            if "error" in res:
+                raise ValueError(res["error"])
+            if res.get("result") is None:
+                raise MissingResultError(f"no trace for {self.txhash}")
+            return res
+
+        try:
+            # a pending tx can't be traced yet, don't wait for it
+            res = call_with_retry(
+                self.w3,
+                "debug_traceTransaction",
+                fetch,
+                attempts=1 if self.is_pending else None,
+            )
+        except RetryError as e:
+            logger.error(
+                f"get calls from debug_traceTransaction failed: {e}, txhash: {self.txhash}"
+            )
+            self.degraded.add("trace")
+            return {"result": {"calls": []}}
+        if not self.is_pending and self._is_finalized(self.block_number):
+            self.store.put(self.chain, "trace", self.block_number, self.txhash, res)
+        return res
 
     ## basic properties from txdata
     @property
@@ -200,9 +457,9 @@ class TX:
         return self.gas_price * self.gas_used
 
     ## basic properties from trace
-    @cached_property
-    def internal_txs(self):
-        return self._internal_txs_from_trace()
+    @property
+    def internal_txs(self) -> List[CallFrame]:
+        return self._trace_summary.internal_txs
 
     @property
     def internal_txs_num(self):
@@ -211,8 +468,22 @@ class TX:
     ## basic properties from block
 
     @cached_property
+    def header(self) -> BlockHeader:
+        if self.is_pending:
+            return None
+        return get_header(self.chain, self.block_number, self.w3)
+
+    @property
     def timestamp(self):
-        return self.w3.eth.get_block(self.block_number)["timestamp"]
+        return self.header.timestamp
+
+    @property
+    def base_fee(self):
+        return self.header.base_fee
+
+    @property
+    def miner(self) -> ChecksumAddress:
+        return self.header.miner
 
     @property
     def is_native_transfer(self) -> bool:
@@ -251,16 +522,12 @@ class TX:
         """
         return len(self.create_calls) > 0
 
-    @cached_property
+    @property
     def create_calls(self) -> list:
         """
         get create and create2 calls
         """
-        calls = []
-        for tx in self.internal_txs:
-            if tx["type"].lower() == "create" or tx["type"] == "create2":
-                calls.append(tx)
-        return calls
+        return self._trace_summary.create_calls
 
     def debug_trace(self, tracer=None, withlog=False):
         if tracer is None:
@@ -273,28 +540,48 @@ class TX:
             [self.txhash, {"tracer": tracer, "tracerConfig": {"withlog": withlog}}],
         )
 
+    def as_call(self) -> dict:
+        """call dict of this tx, see call_object"""
+        return {
+            "from": self.sender,
+            "to": self.to or None,
+            "value": self.value,
+            "data": self.input,
+            "gas": self.gas_limit,
+            "gasPrice": self.gas_price,
+        }
+
     def simulate_call(
-        self, from_address=None, to_address=None, value=None, gas=None, gas_price=None
+        self,
+        from_address=None,
+        to_address=None,
+        value=None,
+        gas=None,
+        gas_price=None,
+        block_number="latest",
     ):
         if from_address is None:
             from_address = self.sender
         if to_address is None:
-            to_address = self.to
+            to_address = self.to or None
         if value is None:
             value = self.value
         if gas is None:
             gas = self.gas_limit
         if gas_price is None:
             gas_price = self.gas_price
+        if block_number == "last":
+            block_number = self.block_number - 1
         return self.w3.eth.call(
             {
                 "from": from_address,
-                "to": self.to,
+                "to": to_address,
                 "value": value,
                 "data": self.input,
                 "gas": gas,
                 "gasPrice": gas_price,
-            }
+            },
+            block_number,
         )
 
     def simulate_debug_trace_call(
@@ -305,46 +592,40 @@ class TX:
         gas=None,
         gas_price=None,
         block_number="latest",
+        state_overrides=None,
     ):
+        """
+        :param block_number: number, tag, or "last" for the block before this tx's
+        :param state_overrides: {address: {"balance", "nonce", "code", "state" or
+            "stateDiff"}}
+        :return: simulated TX, None when the call reverted
+        """
         if from_address is None:
             from_address = self.sender
         if to_address is None:
-            to_address = self.to
+            to_address = self.to or None
         if value is None:
             value = self.value
-        value = int(value)
         if gas is None:
             gas = self.gas_limit
         if gas_price is None:
             gas_price = self.gas_price
-
         if block_number == "last":
-            block_number = hex(self.block_number - 1)
-
-        txdata = {
-            "from": from_address,
-            "to": to_address,
-            "value": value,
-            "data": self.input,
-            "gas": gas,
-            "gasPrice": gas_price,
-        }
+            block_number = self.block_number - 1
 
-        payload = {
-            "from": from_address,
-            "to": self.to,
-            "value": hex(value),
-            "data": self.input_hex,
-            "gas": hex(gas),
-            "gasPrice": hex(gas_price),
-        }
+        payload = call_object(
+            {
+                "from": from_address,
+                "to": to_address,
+                "value": value,
+                "data": self.input,
+                "gas": gas,
+                "gasPrice": gas_price,
+            }
+        )
         trace = self.w3.provider.make_request(
             "debug_traceCall",
-            [
-                payload,
-                "latest",
-                {"tracer": "callTracer", "tracerConfig": {"withLog": True}},
-            ],
+            [payload, block_param(block_number), trace_call_config(state_overrides)],
         )
 
         # check trace error
@@ -354,57 +635,152 @@ class TX:
             )
             return None
 
-        tx = TX(self.chain, DUMMY_TXHASH, w3=self.w3, txdata=txdata, trace=trace)
-        return tx
-
-    @cached_property
-    def max_call_depth(self):
-
-        def parse_calls(calls, depth=0):
-            if len(calls) == 0:
-                return depth
-            max_depth = depth
-            for call in calls:
-                max_depth = max(
-                    max_depth, parse_calls(call.get("calls", []), depth + 1)
-                )
-            return max_depth
+        return TX(
+            self.chain,
+            DUMMY_TXHASH,
+            w3=self.w3,
+            txdata=simulated_txdata(payload),
+            trace=trace,
+        )
 
-        return parse_calls(self.trace["result"].get("calls", []))
+    def simulate_local(self, **call):
+        """
+        run a variant of this tx in process, e.g. simulate_local(value=10**18), on
+        the prestate traced once for it, see prestate.local_evm
 
-    def _internal_txs_from_trace(self):
-        txs = []
+        :param call: fields of the call dict to change, from, to, value, data,
+            gas, gasPrice
+        :return: prestate.SimulationResult
+        """
+        from w3tools.prestate import local_evm  # prestate imports tx
 
-        def parse_calls(calls):
-            if len(calls) == 0:
-                return
-            for call in calls:
-                call = dict(call)
-                call["value"] = int(call.get("value", "0x0"), 16)
-                txs.append(call)
-                parse_calls(call.get("calls", []))
+        return local_evm(self.chain, self, w3=self.w3).call(call)
 
-        # recursive get internal txs
-        try:
-            if self.trace["result"].get("calls", None) != None:
-                parse_calls(self.trace["result"]["calls"])
-        except Exception as e:
-            logger.error(f"get internal txs from trace failed: {e}")
-        return txs
+    @property
+    def max_call_depth(self) -> int:
+        return self._trace_summary.max_call_depth
 
-    def _logs_from_trace(self):
-        logs = []
+    @property
+    def call_type_counts(self) -> Counter:
+        return self._trace_summary.call_type_counts
 
-        def parse_calls(calls):
-            if len(calls) == 0:
-                return
-            for call in calls:
-                logs.extend(call.get("logs", []))
-                parse_calls(call.get("calls", []))
+    def iter_calls(self) -> Iterator[CallFrame]:
+        """lazily walk internal calls, for traces too large to summarize"""
+        return iter_calls(self.trace["result"])
 
+    @cached_property
+    def _trace_summary(self) -> "TraceSummary":
+        summary = TraceSummary()
         try:
-            if self.trace["result"].get("calls", None) != None:
-                parse_calls(self.trace["result"]["calls"])
+            summary.logs.extend(self.trace["result"].get("logs", []))
+            for call in iter_calls(self.trace["result"]):
+                summary.add(call)
         except Exception as e:
-            logger.error(f"get logs from trace failed: {e}")
-        return logs
+            logger.error(f"walk trace failed: {e}, txhash: {self.txhash}")
+        return summary
+
+    def _logs_from_trace(self):
+        return self._trace_summary.logs
+
+
+def load_txs(chain: ChainId, txhashes, w3=None, receipts=False) -> list:
+    """
+    hydrate many TX with json-rpc batches instead of one request per tx
+    """
+    if w3 is None:
+        w3 = make_w3(chain)
+    txhashes = [h.hex() if isinstance(h, bytes) else h for h in txhashes]
+
+    with w3.batch() as batch:
+        for txhash in txhashes:
+            batch.add("eth_getTransactionByHash", [txhash])
+            if receipts:
+                batch.add("eth_getTransactionReceipt", [txhash])
+
+    step = 2 if receipts else 1
+    txdatas = batch.results[::step]
+    _receipts = batch.results[1::step] if receipts else [None] * len(txhashes)
+    return [
+        TX(chain, txhash, w3=w3, txdata=txdata, receipt=receipt)
+        for txhash, txdata, receipt in zip(txhashes, txdatas, _receipts)
+    ]
+
+
+def simulate_many(
+    chain: ChainId,
+    calls,
+    block_number="latest",
+    state_overrides=None,
+    w3=None,
+    bundle=False,
+    batch_size=50,
+    max_workers=4,
+    keep_reverted=False,
+) -> List["TX | None"]:
+    """
+    simulate many txs or call dicts on top of one block, return simulated TXs in
+    input order.
+
+    Every call is traced on its own with batched debug_traceCall, max_workers
+    batches at a time. With bundle, all calls go in one debug_traceCallMany
+    bundle and run one after another, each seeing the state left by the ones
+    before it (erigon, reth, nethermind).
+
+    :param calls: TXs or call dicts, see call_object
+    :param block_number: number or tag of the block to simulate on
+    :param state_overrides: {address: {"balance", "nonce", "code", "state" or
+        "stateDiff"}}, applied to every call
+    :param keep_reverted: return reverted calls too, their trace has an error
+    :return: TX per call, None when the call failed or reverted
+    """
+    if w3 is None:
+        w3 = make_w3(chain)
+    payloads = [call_object(c.as_call() if isinstance(c, TX) else c) for c in calls]
+    block = block_param(block_number)
+    config = trace_call_config(state_overrides)
+
+    if bundle:
+        if not payloads:
+            return []
+        response = w3.provider.make_request(
+            "debug_traceCallMany",
+            [
+                [{"transactions": payloads}],
+                {"blockNumber": block, "transactionIndex": -1},
+                config,
+            ],
+        )
+        if "error" in response:
+            raise ValueError(response["error"])
+        traces = response["result"][0]
+    else:
+
+        def trace(chunk):
+            with w3.batch() as batch:
+                for payload in chunk:
+                    batch.add("debug_traceCall", [payload, block, config])
+            return batch.results
+
+        chunks = [
+            payloads[i : i + batch_size] for i in range(0, len(payloads), batch_size)
+        ]
+        traces = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for results in executor.map(trace, chunks):
+                traces.extend(results)
+
+    txs = []
+    for payload, result in zip(payloads, traces):
+        if result is None or (result.get("error") and not keep_reverted):
+            txs.append(None)
+            continue
+        txs.append(
+            TX(
+                chain,
+                DUMMY_TXHASH,
+                w3=w3,
+                txdata=simulated_txdata(payload),
+                trace={"result": result},
+            )
+        )
+    return txs
@@ -1,11 +1,11 @@
 import asyncio
+import itertools
 import json
-import logging
-import time
+import random
+from functools import partial
 
 from eth_utils.toolz import compose
 from loguru import logger
-from pyrate_limiter import Duration, Limiter, Rate
 from web3 import Web3
 from web3._utils.method_formatters import (
     apply_list_to_array_formatter,
@@ -13,14 +13,42 @@ from web3._utils.method_formatters import (
 )
 from web3._utils.rpc_abi import RPC
 from web3.method import Method, default_root_munger
-from web3.middleware import geth_poa_middleware, simple_cache_middleware, validation
+from web3.middleware import (
+    construct_simple_cache_middleware,
+    geth_poa_middleware,
+    validation,
+)
 from websockets import connect
 
+from w3tools.cassette import CassetteProvider
+from w3tools.cache import (
+    BLOCK_SCOPED_METHODS,
+    SIMPLE_CACHE_METHODS,
+    ReorgAwareCache,
+    construct_reorg_cache_middleware,
+)
 from w3tools.chain import ChainId
-from w3tools.rpc import HTTP_PROVIDERS, RPC_PROVIDER, WS_PROVIDERS
-
-# disable rate limiter logger
-logging.getLogger("pyrate_limiter").setLevel(logging.WARNING)
+from w3tools.metrics import (
+    Metrics,
+    construct_cache_probe_middlewares,
+    construct_metrics_middleware,
+)
+from w3tools.metrics import metrics as default_metrics
+from w3tools.provider import (
+    Batch,
+    BatchHTTPProvider,
+    HedgedHTTPProvider,
+    PooledHTTPProvider,
+)
+from w3tools.raw import decode_rpc_response, raw_request, sized_decoder
+from w3tools.retry import RetryPolicy, default_policy
+from w3tools.ratelimit import (
+    RateLimiter,
+    construct_rate_limit_middleware,
+    endpoint_key,
+    get_bucket,
+)
+from w3tools.rpc import HTTP_PROVIDERS, RPC_PROVIDER, WS_PROVIDERS, pool_endpoints
 
 
 def debug_middle(make_request, w3):
@@ -49,28 +77,104 @@ def make_w3(
     endpoint=None,
     api_key="",
     rate_limit=None,
+    rate_limit_burst=None,
+    method_costs=None,
     debug=False,
     skip_validation=False,
     cache=True,
+    batch_size=None,
+    batch_delay=0.005,
+    raw=False,
+    cassette=None,
+    cassette_mode="hybrid",
+    metrics: Metrics | bool = None,
+    retry: RetryPolicy = None,
+    hedge=False,
+    hedge_budget=0.1,
+    hedge_percentile=0.95,
 ):
     """
     :param chain:
-    :param provider: if provider is custom, endpoint and api_key must be provided
-    :param endpoint: provider endpoint when provider is custom
-    :param api_key: provider api key when needed
-    :param rate_limit: rate_limit every second. Ref: https://github.com/vutran1710/PyrateLimiter
+    :param provider: if provider is custom, endpoint and api_key must be provided,
+        if provider is pool, requests are spread over several endpoints
+    :param endpoint: provider endpoint when provider is custom, list of endpoints
+        when provider is pool (defaults to all remote endpoints of the chain)
+    :param api_key: provider api key when needed, {provider: api_key} for pool and
+        for hedge backups
+    :param rate_limit: requests (or compute units with method_costs) every second
+    :param rate_limit_burst: max requests sent at once, defaults to rate_limit
+    :param method_costs: {method: cost}, e.g. ratelimit.METHOD_COSTS
     :param debug:
+    :param cache: cache responses, block scoped ones are dropped again on reorgs
     :param skip_validation: skip validation for certain methods to reduce rpc call count
+    :param batch_size: coalesce concurrent requests into json-rpc batches of this size
+    :param batch_delay: max seconds a request waits for its batch to fill up
+    :param raw: parse responses with orjson, and let Block and TX fetch through
+        w3.raw_request, which skips middlewares and result formatters and returns
+        lazily converted RawViews
+    :param cassette: cassette file to record requests to and replay them from
+    :param cassette_mode: record, replay (no network at all) or hybrid (replay,
+        record misses)
+    :param metrics: record calls, latencies, retries, rate limiter waits and cache
+        hit rates, True for the shared metrics.metrics, or a Metrics of its own
+    :param retry: how Block and TX retry failed fetches, retry.default_policy
+        when not given
+    :param hedge: send slow read-only requests to a backup endpoint too, True for
+        the chain's other endpoints: the keyless one and the keyed ones with a key
+        in api_key, or a list of endpoints. Chains have a single keyless endpoint,
+        so hedging the default provider needs keys or a list. Not for pool, which
+        fails over already
+    :param hedge_budget: hedges per request, at most
+    :param hedge_percentile: requests slower than this percentile get hedged
     :return:
     """
-    if provider == "custom":
-        if not endpoint:
-            raise ValueError("endpoint must be provided when provider is custom")
+
+    def http_provider(endpoint):
+        if batch_size:
+            http = BatchHTTPProvider(endpoint, batch_size, batch_delay)
+        else:
+            http = Web3.HTTPProvider(endpoint)
+        if raw:
+            http.decode_rpc_response = decode_rpc_response
+        if metrics:
+            # response bytes for the metrics, without encoding responses again
+            http.decode_rpc_response = sized_decoder(http.decode_rpc_response)
+        return http
+
+    if provider == "pool":
+        if endpoint is None:
+            endpoint = pool_endpoints(chain, api_key or None)
+        w3 = Web3(PooledHTTPProvider([http_provider(e) for e in endpoint]))
     else:
-        if isinstance(provider, str):
-            provider = RPC_PROVIDER(provider)
-        endpoint = HTTP_PROVIDERS[chain][provider].format(api_key)
-    w3 = Web3(Web3.HTTPProvider(endpoint))
+        if provider == "custom":
+            if not endpoint:
+                raise ValueError("endpoint must be provided when provider is custom")
+        else:
+            if isinstance(provider, str):
+                provider = RPC_PROVIDER(provider)
+            key = api_key.get(provider, "") if isinstance(api_key, dict) else api_key
+            endpoint = HTTP_PROVIDERS[chain][provider].format(key)
+        if hedge:
+            if hedge is True:
+                keys = api_key if isinstance(api_key, dict) else None
+                hedge = [e for e in pool_endpoints(chain, keys) if e != endpoint]
+                if not hedge:
+                    raise ValueError(
+                        f"no backup endpoint to hedge {chain.name} with, chains have "
+                        "one keyless endpoint: pass api_key={provider: api_key} or "
+                        "hedge=[endpoint, ...]"
+                    )
+            w3 = Web3(
+                HedgedHTTPProvider(
+                    [http_provider(e) for e in [endpoint, *hedge]],
+                    percentile=hedge_percentile,
+                    budget=hedge_budget,
+                )
+            )
+        else:
+            w3 = Web3(http_provider(endpoint))
+    if cassette is not None:
+        w3.provider = CassetteProvider(w3.provider, cassette, cassette_mode)
     # add poa middleware for bsc
     w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
@@ -82,32 +186,70 @@ def make_w3(
             for i in _METHODS_TO_VALIDATE
             if i not in [RPC.eth_call, RPC.eth_estimateGas]
         ]
+    if metrics is True:
+        metrics = default_metrics
+    w3.metrics = metrics or None
     if debug:
         w3.middleware_onion.inject(debug_middle, layer=0)
+    # evicted by ChainFollower on rollbacks
+    w3.reorg_cache = ReorgAwareCache() if cache else None
     if cache:
-        w3.middleware_onion.add(simple_cache_middleware)
+        for name, methods, cache_middleware in (
+            (
+                "simple",
+                SIMPLE_CACHE_METHODS,
+                construct_simple_cache_middleware(rpc_whitelist=SIMPLE_CACHE_METHODS),
+            ),
+            (
+                "reorg",
+                BLOCK_SCOPED_METHODS,
+                construct_reorg_cache_middleware(chain, w3.reorg_cache),
+            ),
+        ):
+            if w3.metrics is None:
+                w3.middleware_onion.add(cache_middleware)
+                continue
+            # lookups pass the outer probe, misses the inner one
+            outer, inner = construct_cache_probe_middlewares(w3.metrics, name, methods)
+            w3.middleware_onion.add(inner)
+            w3.middleware_onion.add(cache_middleware)
+            w3.middleware_onion.add(outer)
     if rate_limit:
-        rates = [Rate(rate_limit, Duration.SECOND * 1)]
-        limiter = Limiter(rates, raise_when_fail=False, max_delay=Duration.SECOND * 1)
-
-        def rate_limit_middleware(make_request, w3):
-            def middleware(method, params):
-                ok = limiter.try_acquire("default")
-                if not ok:
-                    logger.warning(f"rate limit, sleep 0.5s")
-                    time.sleep(0.5)
-                response = make_request(method, params)
-                return response
-
-            return middleware
-
-        w3.middleware_onion.inject(rate_limit_middleware, layer=0)
+        # clients of the same endpoint share one budget
+        bucket = get_bucket(endpoint_key(w3.provider), rate_limit, rate_limit_burst)
+        w3.rate_limiter = RateLimiter(bucket, method_costs, w3.metrics)
+        w3.middleware_onion.inject(
+            construct_rate_limit_middleware(w3.rate_limiter), layer=0
+        )
+    if w3.metrics is not None:
+        # innermost, so only calls which reach the provider are timed
+        w3.middleware_onion.inject(construct_metrics_middleware(w3.metrics), layer=0)
 
     _trace_block = Method(
         "debug_traceBlockByNumber",
         mungers=[default_root_munger],
     )
     w3.eth.attach_methods({"trace_block": _trace_block})
+    if not hasattr(w3.eth, "get_block_receipts"):
+        _get_block_receipts = Method(
+            "eth_getBlockReceipts",
+            mungers=[default_root_munger],
+            result_formatters=lambda method, module: apply_list_to_array_formatter(
+                receipt_formatter
+            ),
+        )
+        w3.eth.attach_methods({"get_block_receipts": _get_block_receipts})
+    w3.chain = chain
+    w3.batch = partial(Batch, w3, batch_size or 100)
+    w3.raw = raw
+    w3.retry_policy = retry or default_policy
+    make_request = None
+    if w3.metrics is not None:
+        # raw requests skip the middlewares, time them all the same
+        make_request = construct_metrics_middleware(w3.metrics)(
+            w3.provider.make_request, w3
+        )
+    w3.raw_request = partial(raw_request, w3, make_request=make_request)
 
     return w3
 
@@ -118,53 +260,218 @@ def make_w3_ws(
     endpoint=None,
     api_key="",
     timeout=10,
+    queue_size=1000,
+    overflow="drop_oldest",
 ):
+    """
+    :param timeout: reconnect when nothing is received for timeout seconds
+    :param queue_size: messages buffered per subscription for slow callbacks
+    :param overflow: what to do when a subscription queue is full, one of
+        block, drop_oldest, drop_newest
+    """
     if provider == "custom":
         if not endpoint:
             raise ValueError("endpoint must be provided when provider is custom")
-    if isinstance(provider, str):
-        provider = RPC_PROVIDER(provider)
-    endpoint = WS_PROVIDERS[chain][provider].format(api_key)
-    return WSClient(chain, endpoint, timeout)
+    else:
+        if isinstance(provider, str):
+            provider = RPC_PROVIDER(provider)
+        endpoint = WS_PROVIDERS[chain][provider].format(api_key)
+    return WSClient(chain, endpoint, timeout, queue_size, overflow)
+
+
+class Subscription:
+    """one eth_subscribe on a WSClient connection, callbacks run off the reader"""
+
+    def __init__(self, params, callback, queue_size=1000, overflow="drop_oldest"):
+        if overflow not in ("block", "drop_oldest", "drop_newest"):
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        self.params = params
+        self.callback = callback
+        self.overflow = overflow
+        self.queue = asyncio.Queue(queue_size)
+        self.id = None
+        self.dropped = 0
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def put(self, message):
+        if self.overflow == "block":
+            await self.queue.put(message)
+            return
+        if self.queue.full():
+            self.dropped += 1
+            if self.overflow == "drop_newest":
+                return
+            self.queue.get_nowait()
+            self.queue.task_done()
+        self.queue.put_nowait(message)
+
+    async def _consume(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                result = self.callback(message)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"ws callback error: {e}, subscription: {self.params}")
+            finally:
+                self.queue.task_done()
+
+    def cancel(self):
+        self._consumer.cancel()
 
 
 class WSClient:
-    def __init__(self, chain: ChainId, w3_ws_endpoint, timeout=10):
+    """
+    one persistent websocket connection per endpoint, shared by all subscriptions.
+
+    Notifications are routed by subscription id to each subscription's queue, and
+    callbacks (sync or async) consume those queues, so a slow callback never stalls
+    the connection. On errors or timeouts the client reconnects with exponential
+    backoff and subscribes everything again.
+
+    callbacks receive the raw notification message.
+    """
+
+    def __init__(
+        self,
+        chain: ChainId,
+        w3_ws_endpoint,
+        timeout=10,
+        queue_size=1000,
+        overflow="drop_oldest",
+        max_backoff=30,
+    ):
         self.chain = chain
         self.w3_ws = w3_ws_endpoint
         self.timeout = timeout
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.max_backoff = max_backoff
+        self.subscriptions = []
+        self._by_id = {}
+        self._requests = {}
+        self._ids = itertools.count(1)
+        self._ws = None
+        self._task = None
+        # serializes (re)subscribing, so a subscription is never sent twice
+        self._lock = asyncio.Lock()
 
     async def subscribe_new_pending_transactions(self, callback):
-        while True:
-            await self.subscribe("newPendingTransactions", callback)
+        await self.subscribe("newPendingTransactions", callback)
+        await self.run_forever()
 
     async def subscribe_new_blocks(self, callback):
-        while True:
-            await self.subscribe("newHeads", callback)
+        await self.subscribe("newHeads", callback)
+        await self.run_forever()
 
-    async def subscribe_logs(self, callback):
-        while True:
+    async def subscribe_logs(self, callback, filter_params=None):
+        """
+        :param filter_params: {"address": ..., "topics": [...]}
+        """
+        if filter_params:
+            await self.subscribe("logs", callback, filter_params)
+        else:
             await self.subscribe("logs", callback)
+        await self.run_forever()
 
-    async def subscribe(self, subscribe_type, callback):
-        async with connect(self.w3_ws) as ws:
-            await ws.send(
+    async def subscribe(self, subscribe_type, callback, *params) -> Subscription:
+        """add a subscription to the shared connection, return without waiting"""
+        subscription = Subscription(
+            [subscribe_type, *params], callback, self.queue_size, self.overflow
+        )
+        async with self._lock:
+            self.subscriptions.append(subscription)
+            if self._ws is not None:
+                await self._subscribe(subscription)
+        self._ensure_running()
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription):
+        async with self._lock:
+            self.subscriptions.remove(subscription)
+            subscription.cancel()
+            if self._ws is not None and subscription.id is not None:
+                self._by_id.pop(subscription.id, None)
+                await self._request("eth_unsubscribe", [subscription.id])
+
+    async def run_forever(self):
+        self._ensure_running()
+        await asyncio.shield(self._task)
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        backoff = 1
+        while True:
+            try:
+                async with connect(self.w3_ws) as ws:
+                    self._ws = ws
+                    asyncio.create_task(self._resubscribe())
+                    backoff = 1
+                    while True:
+                        message = await asyncio.wait_for(
+                            ws.recv(), timeout=self.timeout
+                        )
+                        await self._dispatch(message)
+            except Exception as e:
+                logger.error(f"ws error: {e}, reconnect in {backoff}s")
+            finally:
+                self._ws = None
+                self._by_id.clear()
+                for subscription in self.subscriptions:
+                    subscription.id = None
+                for future in self._requests.values():
+                    future.cancel()
+                self._requests.clear()
+            await asyncio.sleep(backoff * (1 + random.random() / 2))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _resubscribe(self):
+        async with self._lock:
+            for subscription in list(self.subscriptions):
+                if subscription.id is not None:
+                    continue
+                try:
+                    await self._subscribe(subscription)
+                except Exception as e:
+                    logger.error(f"ws subscribe {subscription.params} failed: {e}")
+
+    async def _subscribe(self, subscription: Subscription):
+        subscription.id = await self._request("eth_subscribe", subscription.params)
+        self._by_id[subscription.id] = subscription
+
+    async def _request(self, method, params):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = future
+        try:
+            await self._ws.send(
                 json.dumps(
                     {
                         "jsonrpc": "2.0",
-                        "method": "eth_subscribe",
-                        "params": [subscribe_type],
-                        "id": 1,
+                        "method": method,
+                        "params": params,
+                        "id": request_id,
                     }
                 )
             )
-            _ = await ws.recv()
-            while True:
-                try:
-                    response = await asyncio.wait_for(ws.recv(), timeout=self.timeout)
-                    # time.sleep(0.5)
-                    callback(response)
+            response = await asyncio.wait_for(future, timeout=self.timeout)
+        finally:
+            self._requests.pop(request_id, None)
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
 
-                except Exception as e:
-                    logger.error(f"ws error: {e}")
-                    return
+    async def _dispatch(self, message):
+        data = json.loads(message)
+        if "id" in data:
+            future = self._requests.pop(data["id"], None)
+            if future is not None and not future.done():
+                future.set_result(data)
+            return
+        subscription = self._by_id.get(data.get("params", {}).get("subscription"))
+        if subscription is not None:
+            await subscription.put(message)
@@ -1,13 +1,26 @@
+from dataclasses import dataclass
 from decimal import Decimal
 
 from web3 import Web3
-from w3tools.chain import from w3tools.w3 import make_w3
+from w3tools.abi import ABI_DIR, EventRegistry
+from w3tools.chain import CHAIN_INFO
 
-from core.event.transfer import TransferEvent
-
-with open("etc/abi/weth.json") as f:
+with open(ABI_DIR / "weth.json") as f:
     ABI = f.read()
 
+EVENTS = EventRegistry()
+EVENTS.load_file(ABI_DIR / "weth.json")
+
+
+@dataclass
+class TransferEvent:
+    """a token moving from _from to _to, _value in token units"""
+
+    _token: str
+    _from: str
+    _to: str
+    _value: Decimal
+
 
 # only for weth withdrawl and deposit now
 # TODO: support other xETH?
@@ -20,17 +33,15 @@ class WETHWithdrawalEvent(TransferEvent):
     @classmethod
     def parse(cls, log, w3, **kwargs):
         chain = kwargs["chain"]
-        weth = from w3tools.w3 import make_w3[chain]["weth"]
+        weth = CHAIN_INFO[chain]["weth"]
         event_sig = log["topics"][0]
 
         if event_sig != cls.EVENT_SIG or log["address"] != weth:
             return None
 
-        event = (
-            w3.eth.contract(address=log["address"], abi=ABI)
-            .events.Withdrawal()
-            .process_log(log)
-        )
+        event = EVENTS.decode(log)
+        if event is None:
+            return None
         # decimal is 18
         _value = Decimal(event["args"]["wad"]) / 10**18
         return WETHWithdrawalEvent(
@@ -48,17 +59,15 @@ class WETHDepositEvent(TransferEvent):
     @classmethod
     def parse(cls, log, w3, **kwargs):
         chain = kwargs["chain"]
-        weth = from w3tools.w3 import make_w3[chain]["weth"]
+        weth = CHAIN_INFO[chain]["weth"]
         event_sig = log["topics"][0]
 
         if event_sig != cls.EVENT_SIG or log["address"] != weth:
             return None
 
-        event = (
-            w3.eth.contract(address=log["address"], abi=ABI)
-            .events.Deposit()
-            .process_log(log)
-        )
+        event = EVENTS.decode(log)
+        if event is None:
+            return None
         # decimal is 18
         _value = Decimal(event["args"]["wad"]) / 10**18
         return WETHDepositEvent(